@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Measures how long parsing a generated dashboard takes and how much memory
+# it costs: python3 bench_dashboard.py [ROWS]
+import gc
+import resource
+import sys
+import time
+import tracemalloc
+
+import mentor_dashboard
+
+ROW = ("<tr><td>Unit %(unit)d</td>"
+       "<td><a href=\"https://example.com/students/%(idx)d\">Student %(idx)d</a></td>"
+       "<td>2026-%(month)02d-%(day)02d 12:00</td>"
+       "<td><a href=\"https://drive.google.com/file/d/%(idx)dwork/view\">notebook</a> "
+       "<a href=\"https://github.com/student%(idx)d/capstone\">repo</a></td>"
+       "<td><a href=\"https://docs.google.com/document/d/rubric%(unit)d/edit\">Rubric</a></td>"
+       "<td><a href=\"https://docs.google.com/document/d/solution%(unit)d/edit\">Solution</a></td>"
+       "<td>%(grade)s</td></tr>\n")
+
+
+def dashboard(rows):
+    body = "".join(ROW % {"idx": idx, "unit": idx % 30, "month": idx % 12 + 1, "day": idx % 28 + 1,
+                          "grade": "ABC"[idx % 3]}
+                   for idx in range(rows))
+    return "<html><body><table>\n" + body + "</table></body></html>"
+
+
+def peakRSS():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    html = dashboard(rows)
+    gc.collect()
+    rss_before = peakRSS()
+    start = time.perf_counter()
+    projects = mentor_dashboard.getProjectsFromHTML(html, download_clients={})
+    elapsed = time.perf_counter() - start
+    rss_growth = peakRSS() - rss_before
+    del projects
+    gc.collect()
+
+    tracemalloc.start()
+    projects = mentor_dashboard.getProjectsFromHTML(html, download_clients={})
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("%d rows, %d projects: %.2fs, peak RSS +%d MiB, %.1f MiB retained (tracemalloc)" % (
+        rows, len(projects), elapsed, rss_growth >> 20, retained / float(1 << 20)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+
+
+def fileDigest(path, chunk_size=1 << 20):
+    # md5, to share keys with Drive's md5Checksum
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore(object):
+    STORE_DIR = ".blobs"
+    STATS_FILE = "stats.json"
+
+    def __init__(self, working_dir):
+        self.root = os.path.join(working_dir, self.STORE_DIR)
+        self.stats_file = os.path.join(self.root, self.STATS_FILE)
+        self.lock = threading.Lock()
+        self.stats = {"deduplicated_files": 0, "saved_bytes": 0}
+        if os.path.exists(self.stats_file):
+            try:
+                with open(self.stats_file) as f:
+                    self.stats.update(json.load(f))
+            except ValueError:
+                pass
+
+    def blobPath(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return digest is not None and os.path.exists(self.blobPath(digest))
+
+    def recordSaving(self, size):
+        with self.lock:
+            self.stats["deduplicated_files"] += 1
+            self.stats["saved_bytes"] += size
+            os.makedirs(self.root, exist_ok=True)
+            staging = self.stats_file + ".%d" % os.getpid()
+            with open(staging, "w") as f:
+                json.dump(self.stats, f)
+            os.replace(staging, self.stats_file)
+
+    def linkInto(self, digest, destination):
+        # None if there is no such blob, including one garbage collection
+        # removed since has() said there was; the caller downloads instead.
+        # destination is only replaced once the link exists
+        if digest is None:
+            return None
+        blob = self.blobPath(digest)
+        staging = destination + ".blob"
+        if os.path.lexists(staging):
+            os.unlink(staging)
+        try:
+            os.link(blob, staging)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            try:
+                shutil.copy2(blob, staging)
+            except FileNotFoundError:
+                return None
+        os.replace(staging, destination)
+        self.recordSaving(os.path.getsize(destination))
+        return destination
+
+    def ingest(self, path, digest=None):
+        if digest is None:
+            digest = fileDigest(path)
+        if self.linkInto(digest, path) is not None:
+            return path
+        blob = self.blobPath(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            # Another download stored the same content first
+            self.linkInto(digest, path)
+            return path
+        except OSError:
+            # Different filesystem; keep the private copy
+            return path
+        # Every project shares the blob's inode, so an in-place edit in one
+        # would silently change the others
+        os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        return path
+
+    def ingestTree(self, fs_root):
+        for root, _, files in os.walk(fs_root):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    self.ingest(path)
+
+    def collectGarbage(self):
+        # Blobs no project links to any more
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for root, _, files in os.walk(self.root):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if filename != self.STATS_FILE and os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+    def inodes(self):
+        found = set()
+        for root, _, files in os.walk(self.root):
+            for filename in files:
+                if filename == self.STATS_FILE:
+                    continue
+                try:
+                    info = os.stat(os.path.join(root, filename))
+                except OSError:
+                    continue
+                found.add((info.st_dev, info.st_ino))
+        return found
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return "%d files deduplicated, %.1f MiB saved" % (
+            stats["deduplicated_files"], stats["saved_bytes"] / float(1 << 20))
@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import difflib
+import json
 import os
+import sqlite3
 import sys
+import threading
 
+import dateutil.parser
 import urwid
 
 import mentor_dashboard
 import shell_integration
 import generic_widgets
+import download_queue
+import launcher
+import providers
+import reference_cache
+import search_index
+import stall_detector
+import storage
+import blobstore
+import sync_daemon
 
 import gdrive
 import github
+import http_client
 
 DEFAULT_PALETTE = (
     ('titlebar', urwid.BLACK, urwid.LIGHT_GRAY),
@@ -22,37 +38,54 @@ class InitializeGdriveClient(generic_widgets.PopupDialog):
     def __init__(self, loop, client, completionCallback=None, failureCallback=None):
         self.completionCallback = completionCallback
         self.failureCallback = failureCallback
-        if not client.initialized():
-            if not client.initialize(attemptAuthorization=False):
-                self.client = client
-
-                continue_button = generic_widgets.HighlightableListRow(urwid.Text("[Continue]"))
-                urwid.connect_signal(continue_button, 'click', self.begin)
-                urwid.connect_signal(continue_button, 'doubleclick', self.begin)
-
-                cancel_button = generic_widgets.HighlightableListRow(urwid.Text("[Cancel]"))
-                urwid.connect_signal(cancel_button, 'click', self.detach)
-                urwid.connect_signal(cancel_button, 'doubleclick', self.detach)
-                
-                self.label = urwid.Text(
-                    "To download files from your Google Drive, you "
-                    "must first authorize this application to access "
-                    "your account. Select 'continue' to begin this "
-                    "authorization process.\n")
-
-                self.buttons = urwid.Columns((continue_button, cancel_button))
-
-                widget = urwid.Pile((
-                    self.label,
-                    self.buttons
-                ))
-                super().__init__(loop, widget, True, 65)
-            else:
-                if self.completionCallback is not None:
-                    self.completionCallback()
+        self.client = client
+
+        continue_button = generic_widgets.HighlightableListRow(urwid.Text("[Continue]"))
+        urwid.connect_signal(continue_button, 'click', self.begin)
+        urwid.connect_signal(continue_button, 'doubleclick', self.begin)
+
+        cancel_button = generic_widgets.HighlightableListRow(urwid.Text("[Cancel]"))
+        urwid.connect_signal(cancel_button, 'click', self.detach)
+        urwid.connect_signal(cancel_button, 'doubleclick', self.detach)
+
+        self.label = urwid.Text(
+            "To download files from your Google Drive, you "
+            "must first authorize this application to access "
+            "your account. Select 'continue' to begin this "
+            "authorization process.\n")
+
+        self.buttons = urwid.Columns((continue_button, cancel_button))
+
+        widget = urwid.Pile((
+            self.label,
+            self.buttons
+        ))
+        super().__init__(loop, widget, False, 65)
+
+        if client is None or client.initialized():
+            self.complete()
+        elif not os.path.exists(client.token_file):
+            self.attach()
         else:
-            if self.completionCallback is not None:
-                self.completionCallback()
+            # Loading and refreshing the token waits on the disk and the
+            # network (and on a background initialize holding the client's
+            # lock), so it never runs on the urwid thread
+            dispatcher = generic_widgets.LoopDispatcher.get(loop)
+
+            def body():
+                try:
+                    success = client.initialize(attemptAuthorization=False)
+                except Exception as e:
+                    dispatcher.call(self.fail, "Could not load your Google Drive "
+                                               "authorization:\n\n%s\n" % e)
+                    dispatcher.call(self.attach)
+                    return
+                dispatcher.call(self.complete if success else self.attach)
+            threading.Thread(target=body, daemon=True).start()
+
+    def complete(self):
+        if self.completionCallback is not None:
+            self.completionCallback()
 
     def fail(self, failure_text):
         self.label.set_text(failure_text)
@@ -140,6 +173,45 @@ class FilterDialog(generic_widgets.PopupDialog):
         self.detach()
 
 
+class SearchDialog(generic_widgets.PopupDialog):
+    def __init__(self, loop, initial_query, set_query_callback, attach=True):
+        self.set_query_callback = set_query_callback
+
+        search_button = generic_widgets.HighlightableListRow(urwid.Text("[Search]"))
+        urwid.connect_signal(search_button, 'click', self.search_callback)
+        urwid.connect_signal(search_button, 'doubleclick', self.search_callback)
+
+        clear_button = generic_widgets.HighlightableListRow(urwid.Text("[Clear]"))
+        urwid.connect_signal(clear_button, 'click', self.clear_callback)
+        urwid.connect_signal(clear_button, 'doubleclick', self.clear_callback)
+
+        cancel_button = generic_widgets.HighlightableListRow(urwid.Text("[Cancel]"))
+        urwid.connect_signal(cancel_button, 'click', self.detach)
+        urwid.connect_signal(cancel_button, 'doubleclick', self.detach)
+
+        self.query_entry = urwid.Edit("Find: ", initial_query or "")
+        widget = urwid.Pile((
+            urwid.Text("Show projects whose downloaded files contain:"),
+            self.query_entry,
+            urwid.Columns((search_button, clear_button, cancel_button))
+        ))
+        super().__init__(loop, widget, attach, 50)
+
+    def keypress(self, size, key):
+        if key == "enter":
+            self.search_callback()
+            return None
+        return super().keypress(size, key)
+
+    def search_callback(self):
+        self.detach()
+        self.set_query_callback(self.query_entry.edit_text)
+
+    def clear_callback(self):
+        self.detach()
+        self.set_query_callback("")
+
+
 class OperationsPopup(generic_widgets.PopupDialog):
     def __init__(self, loop, project, attach=True):
         self.project = project
@@ -177,77 +249,163 @@ class OperationsPopup(generic_widgets.PopupDialog):
         self.detach()
 
     def openSolution(self, *args, **kwargs):
-        for link in self.project.solution.values():
-            shell_integration.openLink(link)
-        self.detach()
+        self.openReferences(self.project.solution.values())
 
     def openRubric(self, *args, **kwargs):
-        for link in self.project.rubric.values():
-            shell_integration.openLink(link)
+        self.openReferences(self.project.rubric.values())
+
+    def openReferences(self, links):
+        # Downloaded once per unit and opened locally, falling back to the
+        # browser for links no client can fetch
+        links = list(links)
+        dispatcher = generic_widgets.LoopDispatcher.get(self.loop)
+
+        def body():
+            for link in links:
+                try:
+                    local_uri = self.project.getReferenceURI(link)
+                except Exception:
+                    local_uri = None
+                if local_uri is None:
+                    dispatcher.call(shell_integration.openLink, link)
+                else:
+                    dispatcher.call(shell_integration.openFolder, local_uri)
+
+        def begin():
+            threading.Thread(target=body, daemon=True).start()
         self.detach()
+        InitializeGdriveClient(
+            self.loop, self.project.download_clients.get("gdrive"),
+            completionCallback=begin)
 
     def openWorkLinks(self, *args, **kwargs):
         for link in self.project.work.values():
             shell_integration.openLink(link)
         self.detach()
 
-    def openLocalUris(self, *args, **kwargs):
-        def completion():
-            for uri in self.project.getLocalURIs().values():
-                shell_integration.openFolder(uri)
+    def fetchLocalURIs(self, completion):
+        # Runs on the download queue; the completion is handed back to the
+        # urwid thread so the popup callbacks never block input
+        dispatcher = generic_widgets.LoopDispatcher.get(self.loop)
+
+        def failure(error):
+            dispatcher.call(generic_widgets.MessageDialog, self.loop,
+                            "Could not download project:\n\n%s" % error)
+
+        def begin():
+            self.project.fetchLocalURIs(
+                lambda local_uris: dispatcher.call(completion, local_uris),
+                failure)
         self.detach()
         InitializeGdriveClient(
-            self.loop, self.project.download_clients["gdrive"],
-            completionCallback=completion)
+            self.loop, self.project.download_clients.get("gdrive"),
+            completionCallback=begin)
+
+    def openLocalUris(self, *args, **kwargs):
+        def completion(local_uris):
+            for uri in local_uris.values():
+                shell_integration.openFolder(uri)
+        self.fetchLocalURIs(completion)
 
     def uriToClipboard(self, *args, **kwargs):
-        def completion():
-            uris = []
-            for uri in self.project.getLocalURIs().values():
-                uris.append(uri)
-            uris = ";".join(uris)
-            shell_integration.copyText(uris)
-        self.detach()
-        InitializeGdriveClient(
-            self.loop, self.project.download_clients["gdrive"],
-            completionCallback=completion)
+        def completion(local_uris):
+            shell_integration.copyText(";".join(local_uris.values()))
+        self.fetchLocalURIs(completion)
 
 
 class ProjectRow(generic_widgets.HighlightableListRow):
     DATE_FORMAT = "%b %-d %Y"
     HOTKEYS = {
         "detail": ("tab", "right"),
+        "mark": ("m", "insert"),
+    }
+    STATUS_INDICATORS = {
+        None: " ",
+        "queued": ".",
+        "downloading": ">",
+        "done": "=",
+        "failed": "!",
+        "cancelled": " ",
     }
 
     def __init__(self, project, loop):
         self.project = project
         self.loop = loop
+        self.selected = False
+        self.marked = False
+        # Opened or downloading as part of the last batch
+        self.batch_member = False
+        self.status = None
         self.selected_indicator_widget = urwid.Text("")
-        self.set_selected(False)
+        self.date_widget = urwid.Text("")
+        self.refresh()
         cells = urwid.Columns([
             ('pack', self.selected_indicator_widget),
             ('pack', urwid.Text(project.unit.ljust(5))),
             ('weight', 70, urwid.Text(project.name)),
-            ('pack', urwid.Text(project.date.strftime(self.DATE_FORMAT)))
+            ('pack', self.date_widget)
         ], dividechars=1)
         super().__init__(cells)
 
+    def refresh(self):
+        if self.selected:
+            selection = "*"
+        elif self.marked:
+            selection = "+"
+        else:
+            selection = " "
+        self.selected_indicator_widget.set_text(
+            "[%s%s]" % (selection, self.STATUS_INDICATORS[self.status]))
+        self.date_widget.set_text(self.project.date.strftime(self.DATE_FORMAT))
+
     def keypress(self, size, key):
         if key in self.HOTKEYS["detail"]:
             OperationsPopup(self.loop, self.project)
             return None
+        if key in self.HOTKEYS["mark"]:
+            self.set_marked(not self.marked)
+            return "down"
         return super().keypress(size, key)
 
+    def set_marked(self, value):
+        self.marked = value
+        self.refresh()
+        if value is False:
+            self.leave_batch()
+
+    def leave_batch(self):
+        if not self.batch_member:
+            return
+        self.batch_member = False
+        # A batch member that is also the selected project stays open until
+        # it is deselected
+        if not self.selected:
+            self.project.close()
+
+    def set_status(self, status):
+        self.status = status
+        self.refresh()
+
     def set_selected(self, value):
         self.selected = value
-        self.selected_indicator_widget.set_text("[%s]" % ("*" if value else " "))
+        self.refresh()
+        if value is True and self.project.openContexts is not None:
+            # Already opened (or opening) by a batch
+            return
         if value is True:
+            # Fetched here on the urwid thread; failure runs on a worker
+            dispatcher = generic_widgets.LoopDispatcher.get(self.loop)
+
+            def failure(error):
+                dispatcher.call(generic_widgets.MessageDialog, self.loop,
+                                "Could not open project:\n\n%s" % error)
+
             def completion():
-                self.project.open()
+                self.project.open(openFailureCallback=failure)
             InitializeGdriveClient(
-                self.loop, self.project.download_clients["gdrive"],
+                self.loop, self.project.download_clients.get("gdrive"),
                 completionCallback=completion)
-        else:
+        elif not self.batch_member:
             self.project.close()
 
 
@@ -274,11 +432,27 @@ class BrowserApplication(object):
     HOTKEYS = {
         "reload": ("ctrl r",),
         "filter": ("ctrl f",),
+        "batch open": ("ctrl o",),
+        "search": ("/",),
+        "stalls": ("ctrl t",),
         "quit": ("q", "Q")
     }
 
-    def __init__(self, palette, working_dir, download_clients, project_filter, data_source):
+    def __init__(self, palette, working_dir, download_clients, project_filter, data_source,
+                 daemon=None, max_downloads=download_queue.DownloadQueue.DEFAULT_WORKERS,
+                 storage=None, search_index=None, references=None,
+                 stall_threshold=stall_detector.StallDetector.DEFAULT_THRESHOLD, stall_log=None,
+                 offline=False):
         self.data_source = data_source
+        self.daemon = daemon
+        self.daemon_html = None
+        self.storage = storage
+        self.search_index = search_index
+        self.references = references
+        self.offline = offline
+        self.search_filter = None
+        self.download_queue = download_queue.DownloadQueue(
+            max_downloads, statusCallback=self.download_status)
         self.palette = palette
         self.working_dir = working_dir
         self.download_clients = download_clients
@@ -287,7 +461,10 @@ class BrowserApplication(object):
             self.working_dir = os.path.join(os.getcwd(), "downloads")
         self.loop = urwid.MainLoop(None, self.palette,
                                    unhandled_input=self.global_input)
-        title_bar = urwid.AttrMap(urwid.Filler(urwid.Padding(urwid.Text("Projects")),'top'),'titlebar')
+        # Created before any worker thread can ask for it
+        self.dispatcher = generic_widgets.LoopDispatcher.get(self.loop)
+        title = "Projects (offline)" if self.offline else "Projects"
+        title_bar = urwid.AttrMap(urwid.Filler(urwid.Padding(urwid.Text(title)),'top'),'titlebar')
 
         if project_filter is None:
             self.project_filter = mentor_dashboard.ProjectFilter()
@@ -303,6 +480,7 @@ class BrowserApplication(object):
             hotkey_widgets.append(toolbar_button)
             urwid.connect_signal(toolbar_button, 'click', self.handle_toolbar_click, user_args=[hotkey[0]])
 
+        self.projects = []
         self.project_list_walker = urwid.SimpleFocusListWalker([])
         self.project_list = RadioListbox(self.project_list_walker)
         self.loop.widget = urwid.Pile((
@@ -311,7 +489,12 @@ class BrowserApplication(object):
             (4, urwid.Columns(hotkey_widgets))
         ))
         self.waitDialog = None
-        self.downloadDialog = generic_widgets.WaitDialog(self.loop, "Downloading project", attach=False, threadable=True)
+        self.stall_detector = None
+        if stall_threshold is not None and stall_threshold > 0:
+            self.stall_detector = stall_detector.StallDetector(self.loop, stall_threshold, stall_log)
+        # Downloads run in the background, so the dialog can be dismissed
+        self.downloadDialog = generic_widgets.WaitDialog(
+            self.loop, "Downloading project", attach=False, threadable=True, cancelable=True)
 
     def handle_toolbar_click(self, hotkey):
         self.loop.process_input((hotkey,))
@@ -320,18 +503,26 @@ class BrowserApplication(object):
         self.project_filter = new_filter
         self.update_project_ui()
 
+    def set_search(self, query):
+        if query.strip() == "":
+            self.search_filter = None
+        elif self.search_index is None:
+            generic_widgets.MessageDialog(self.loop, "Searching needs a working dir")
+            return
+        else:
+            try:
+                self.search_filter = mentor_dashboard.SearchProjectFilter(self.search_index, query)
+            except Exception as e:
+                generic_widgets.MessageDialog(self.loop, "Could not search:\n\n%s" % e)
+                return
+        self.update_project_ui()
+
     def poll_clipboard(self, loop, unused=None):
         success = False
         clipboard_result = shell_integration.getHTMLFromClipboard()
         if clipboard_result is not None:
-            self.projects = mentor_dashboard.getProjectsFromHTML(
-                clipboard_result,
-                download_clients=self.download_clients,
-                working_dir=self.working_dir,
-                startCallback=self.startDownloadDialog,
-                progressCallback=self.progressDownloadDialog,
-                completionCallback=self.completeDownloadDialog
-            )
+            self.projects = mentor_dashboard.mergeProjects(
+                self.projects, self.parse_projects(clipboard_result))
             success = self.update_project_ui()
         if success:
             if self.waitDialog is not None:
@@ -343,30 +534,174 @@ class BrowserApplication(object):
                 self.waitDialog = generic_widgets.WaitDialog(loop, "Waiting for valid dashboard contents in clipboard")
 
     def reload_projects(self):
-        self.project_list_walker.clear()
+        if self.data_source is None and self.daemon is not None:
+            # Attached to a daemon that already has a dashboard: its parsed
+            # projects are used as they are
+            projects = self.daemon_projects()
+            if len(projects) > 0:
+                self.projects = mentor_dashboard.mergeProjects(self.projects, projects)
+                self.update_project_ui()
+                return
         if self.data_source is None:
             self.poll_clipboard(self.loop)
         else:
-            self.projects = mentor_dashboard.getProjectsFromHTML(
-                self.data_source,
-                download_clients=self.download_clients,
-                working_dir=self.working_dir,
-                startCallback=self.startDownloadDialog,
-                progressCallback=self.progressDownloadDialog,
-                completionCallback=self.completeDownloadDialog
-            )
+            self.projects = mentor_dashboard.mergeProjects(
+                self.projects, self.parse_projects(self.data_source))
             self.update_project_ui()
 
+    def workspace_options(self):
+        return dict(
+            download_clients=self.download_clients,
+            working_dir=self.working_dir,
+            startCallback=self.startDownloadDialog,
+            progressCallback=self.progressDownloadDialog,
+            completionCallback=self.completeDownloadDialog,
+            daemon=self.daemon,
+            download_queue=self.download_queue,
+            storage=self.storage,
+            search_index=self.search_index,
+            reference_cache=self.references,
+            offline=self.offline
+        )
+
+    def daemon_projects(self):
+        try:
+            records = self.daemon.projects()
+        except (OSError, ValueError, sync_daemon.DaemonError):
+            return []
+        return mentor_dashboard.getProjectsFromRecords(records, **self.workspace_options())
+
+    def parse_projects(self, html):
+        if self.daemon is not None:
+            self.load_into_daemon(html)
+        projects = mentor_dashboard.getProjectsFromHTML(html, **self.workspace_options())
+        self.prefetch_metadata(projects)
+        return projects
+
+    def load_into_daemon(self, html):
+        # The daemon parses the whole dashboard too, so it's handed over in
+        # the background, and only when it's not what was last handed over
+        if html == self.daemon_html:
+            return
+        self.daemon_html = html
+        dispatcher = self.dispatcher
+
+        def body():
+            try:
+                self.daemon.load(html)
+            except Exception as e:
+                dispatcher.call(generic_widgets.MessageDialog, self.loop,
+                                "Could not hand the dashboard to the daemon:\n\n%s" % e)
+        threading.Thread(target=body, daemon=True).start()
+
+    def prefetch_metadata(self, projects):
+        def body():
+            try:
+                mentor_dashboard.prefetchMetadata(projects, self.download_clients)
+            except Exception:
+                # Purely an optimization; downloads look metadata up themselves
+                pass
+        threading.Thread(target=body, daemon=True).start()
+
     def update_project_ui(self):
-        self.project_list_walker.clear()
+        # Only rows whose project appeared, disappeared or changed are
+        # touched, so the selection and open projects survive a reload
         self.displayed_projects = self.project_filter.filter(self.projects)
-        if len(self.projects) > 0:
-            for project in self.displayed_projects:
-                project_widget = ProjectRow(project, self.loop)
-                self.project_list_walker.append(project_widget)
-                urwid.connect_signal(project_widget, 'doubleclick', self.project_list.update_selected)
-            return True
-        return False
+        if self.search_filter is not None:
+            self.displayed_projects = self.search_filter.filter(self.displayed_projects)
+        walker = self.project_list_walker
+        old_keys = [row.project.key() for row in walker]
+        new_keys = [project.key() for project in self.displayed_projects]
+        matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+        opcodes = matcher.get_opcodes()
+        # A project that moved (a resubmission sorts higher up) shows up as
+        # removed in one place and inserted in another; it keeps its row,
+        # and with it the selection, mark and download status
+        movable = {}
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != "equal":
+                for row in walker[i1:i2]:
+                    movable.setdefault(row.project.key(), []).append(row)
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag == "equal":
+                for row in walker[i1:i2]:
+                    if row.project.updated:
+                        row.refresh()
+                        row.project.updated = False
+                continue
+            new_rows = []
+            for project in self.displayed_projects[j1:j2]:
+                candidates = movable.get(project.key())
+                if candidates:
+                    project_widget = candidates.pop(0)
+                    project_widget.project = project
+                    project_widget.refresh()
+                    project.updated = False
+                else:
+                    project_widget = ProjectRow(project, self.loop)
+                    urwid.connect_signal(project_widget, 'doubleclick', self.project_list.update_selected)
+                new_rows.append(project_widget)
+            walker[i1:i2] = new_rows
+        # Only projects that are gone from the list are closed
+        for rows in movable.values():
+            for row in rows:
+                if row is self.project_list.cur_selected:
+                    row.set_selected(False)
+                    self.project_list.cur_selected = None
+                row.leave_batch()
+        return len(self.projects) > 0
+
+    def download_status(self, project, status):
+        self.dispatcher.call(self.show_download_status, project.key(), status)
+
+    def show_download_status(self, key, status):
+        for row in self.project_list_walker:
+            if row.project.key() == key:
+                row.set_status(status)
+
+    def batch_open(self):
+        # Marked projects go through the shared queue oldest first, so the
+        # ones waiting longest for review are ready first
+        marked = [row for row in self.project_list_walker if row.marked]
+        marked.sort(key=lambda row: row.project.date)
+        if len(marked) == 0:
+            generic_widgets.MessageDialog(
+                self.loop, "Mark projects with %s first" % "/".join(ProjectRow.HOTKEYS["mark"]))
+            return
+        # The previous batch's projects are closed, unless they're in this
+        # one too
+        for row in self.project_list_walker:
+            if row.batch_member and not row.marked:
+                row.leave_batch()
+        for row in marked:
+            row.batch_member = True
+
+        # Only as many projects are opened as the launcher keeps workspaces
+        # for, so opening the newest doesn't close the oldest; the rest are
+        # just downloaded, ready to be opened one by one
+        room = shell_integration.active_launcher.max_workspaces
+        if room is None:
+            room = len(marked)
+        selected = self.project_list.cur_selected
+        if selected is not None and selected not in marked:
+            room -= 1
+        dispatcher = self.dispatcher
+
+        def failure(error):
+            dispatcher.call(generic_widgets.MessageDialog, self.loop,
+                            "Could not open project:\n\n%s" % error)
+
+        def begin():
+            for idx, row in enumerate(marked):
+                if row.project.openContexts is not None:
+                    continue
+                if idx < room:
+                    row.project.open(openFailureCallback=failure)
+                else:
+                    row.project.fetchLocalURIs(failureCallback=failure)
+        InitializeGdriveClient(
+            self.loop, self.download_clients.get("gdrive"),
+            completionCallback=begin)
 
     def startDownloadDialog(self, service):
         self.downloadDialog.service = service
@@ -381,8 +716,20 @@ class BrowserApplication(object):
 
     def run(self):
         shell_integration.syncShells(self.working_dir)
+        gdrive_client = self.download_clients.get("gdrive")
+        if gdrive_client is not None and not gdrive_client.initialized():
+            gdrive_client.initializeInBackground()
         self.reload_projects()
-        self.loop.run()
+        if self.stall_detector is not None:
+            self.stall_detector.start()
+        try:
+            self.loop.run()
+        finally:
+            if self.stall_detector is not None:
+                self.stall_detector.stop()
+            # Nothing left to open them in; partial output is cleaned up
+            self.download_queue.cancelAll()
+            self.download_queue.shutdown(wait=False)
 
     def global_input(self, key):
         if key in self.HOTKEYS["reload"]:
@@ -391,14 +738,153 @@ class BrowserApplication(object):
         if key in self.HOTKEYS["filter"]:
             FilterDialog(self.loop, self.project_filter, self.set_filter)
             return None
+        if key in self.HOTKEYS["batch open"]:
+            self.batch_open()
+            return None
+        if key in self.HOTKEYS["stalls"]:
+            if self.stall_detector is None:
+                generic_widgets.MessageDialog(self.loop, "Stall detection is off (--stall-threshold 0)")
+            else:
+                generic_widgets.MessageDialog(self.loop, self.stall_detector.report(), width=100)
+            return None
+        if key in self.HOTKEYS["search"]:
+            SearchDialog(self.loop, getattr(self.search_filter, "query", None), self.set_search)
+            return None
         if key in self.HOTKEYS["quit"]:
             raise urwid.ExitMainLoop()
 
 
+def syncAll(projects, download_clients, max_workers):
+    for client_name, client in download_clients.items():
+        if not client.initialized() and not client.initialize(attemptAuthorization=False):
+            print("warning: %s client is not authorized, its links will fail to "
+                  "download (run the browser interactively once to authorize)" % client_name,
+                  file=sys.stderr)
+
+    try:
+        mentor_dashboard.prefetchMetadata(projects, download_clients)
+    except Exception as e:
+        print("warning: could not prefetch link metadata: %s" % e, file=sys.stderr)
+
+    queue = download_queue.DownloadQueue(max_workers)
+    jobs = {queue.submit(project): project for project in projects}
+    failures = 0
+    for job in concurrent.futures.as_completed(jobs):
+        project = jobs[job]
+        try:
+            local_uris = job.result()
+            print("ok      %s %s (%d links)" % (project.unit, project.name, len(local_uris)))
+        except Exception as e:
+            failures += 1
+            print("failed  %s %s: %s" % (project.unit, project.name, e), file=sys.stderr)
+    queue.shutdown()
+
+    print("synced %d of %d projects, %d failed" % (len(jobs) - failures, len(jobs), failures))
+    for client_name, client in download_clients.items():
+        if getattr(client, "scheduler", None) is not None:
+            print("%s: %s" % (client_name, client.scheduler.summary()))
+    return 0 if failures == 0 else 1
+
+
+def runDaemon(socket_path, download_clients, working_dir, max_workers, data_source, storage_manager,
+              search_index):
+    server = sync_daemon.SyncDaemon(socket_path, download_clients, working_dir, max_workers,
+                                    storage_manager, search_index)
+    server.initializeClients()
+    if data_source is not None:
+        server.load({"html": data_source})
+    print("listening on %s" % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def runSearch(search_index, query, reindex):
+    if reindex:
+        print("indexed %d files" % search_index.updateAll(), file=sys.stderr)
+    if query is None:
+        return 0
+    try:
+        results = search_index.search(query)
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    except sqlite3.OperationalError as e:
+        # e.g. an index built with fts5 opened by an sqlite without it
+        print("error: the search index at %s can't be read (%s); delete it and rerun with --reindex" % (
+            search_index.index_file, e), file=sys.stderr)
+        return 1
+    for project, path in results:
+        print("%s\t%s" % (project, os.path.join(search_index.working_dir, path)))
+    return 0 if len(results) > 0 else 1
+
+
+QUERY_FIELDS = ("unit", "name", "date", "work", "rubric", "solution", "grade",
+                "project_dir", "status", "local_paths")
+
+
+def parseFields(text):
+    fields = tuple(field.strip() for field in text.split(",") if field.strip() != "")
+    unknown = [field for field in fields if field not in QUERY_FIELDS]
+    if len(unknown) > 0 or len(fields) == 0:
+        raise argparse.ArgumentTypeError(
+            "unknown fields %s (choose from %s)" % (",".join(unknown), ",".join(QUERY_FIELDS)))
+    return fields
+
+
+def runQuery(source, project_filters, fields, working_dir, storage_manager):
+    # Projects are written out as they are parsed and then dropped, so
+    # memory stays flat however long the dashboard is
+    projects = mentor_dashboard.iterProjectsFromHTML(
+        source, share_links=False, download_clients={}, working_dir=working_dir,
+        storage=storage_manager)
+    try:
+        for project in projects:
+            if not all(project_filter.matches(project) for project_filter in project_filters):
+                continue
+            record = {}
+            if "status" in fields or "local_paths" in fields:
+                record["status"], record["local_paths"] = project.localStatus()
+            if "project_dir" in fields:
+                record["project_dir"] = project.projectDir()
+            for field in fields:
+                if field not in record:
+                    value = getattr(project, field)
+                    record[field] = value.isoformat() if field == "date" else value
+            sys.stdout.write(json.dumps({field: record[field] for field in fields}) + "\n")
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The consumer (head, jq -e ...) stopped reading; that's not an error
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 0
+
+
+def runDaemonCommand(daemon, args):
+    try:
+        if args.open is not None:
+            for uri in daemon.fetch(query=args.open).values():
+                shell_integration.openFolder(uri)
+        elif args.copy_path is not None:
+            shell_integration.copyText(";".join(daemon.fetch(query=args.copy_path).values()))
+        elif args.list is not None:
+            for record in daemon.list(args.list):
+                print("%s\t%s\t%s" % (record["unit"], record["name"], record["date"]))
+    except sync_daemon.DaemonError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
 def main():
     parser = argparse.ArgumentParser(description='workspace switcher for springboard project submissions')
     parser.add_argument("--stdin", action="store_true",
                         help="Read dashboard data from STDIN")
+    parser.add_argument("--dashboard", metavar="HTML_FILE", type=str,
+                        help="Read dashboard data from HTML_FILE")
     parser.add_argument("--gdrive-credentials", metavar="CREDENTIALS_JSON_FILE", type=str,
                         default=gdrive.GdriveClient.CREDENTIALS_FILE,
                         help="Path to JSON file containing GDrive API credentials. Default is \"%s\"" % gdrive.GdriveClient.CREDENTIALS_FILE)
@@ -409,17 +895,130 @@ def main():
                         help="Hide submissions older than DAYS old")
     parser.add_argument("--working-dir", metavar="DOWNLOADS_DIR", type=str,
                         help="Directory to use for downloads and settings")
+    parser.add_argument("--shell-session", metavar="SESSION", type=shell_integration.parseShellSession,
+                        default=shell_integration.DEFAULT_SHELL_SESSION,
+                        help="Session name that shells attached with tourguide.sh follow. "
+                             "Default is \"%s\"" % shell_integration.DEFAULT_SHELL_SESSION)
+    parser.add_argument("--max-workspaces", metavar="N", type=int,
+                        default=launcher.Launcher.DEFAULT_MAX_WORKSPACES,
+                        help="Close the viewers started for the least recently opened project "
+                             "when more than N projects are open. Sublime windows, and apps "
+                             "xdg-open hands files to, are left open. Default is %d" %
+                             launcher.Launcher.DEFAULT_MAX_WORKSPACES)
+    parser.add_argument("--disk-budget", metavar="SIZE", type=storage.parseSize,
+                        help="Compress, then evict, the least recently opened projects "
+                             "once the working dir grows past SIZE (e.g. 20G)")
+    parser.add_argument("--offline", action="store_true",
+                        help="Make no network calls: open what is already downloaded and "
+                             "report the links that aren't")
+    parser.add_argument("--connect-timeout", metavar="SECONDS", type=float,
+                        default=http_client.HttpClient.DEFAULT_CONNECT_TIMEOUT,
+                        help="Give up connecting to a file host after SECONDS. Default is %d" %
+                             http_client.HttpClient.DEFAULT_CONNECT_TIMEOUT)
+    parser.add_argument("--read-timeout", metavar="SECONDS", type=float,
+                        default=http_client.HttpClient.DEFAULT_READ_TIMEOUT,
+                        help="Give up on a download that receives nothing for SECONDS. "
+                             "Default is %d" % http_client.HttpClient.DEFAULT_READ_TIMEOUT)
+    parser.add_argument("--stall-threshold", metavar="SECONDS", type=float,
+                        default=stall_detector.StallDetector.DEFAULT_THRESHOLD,
+                        help="Record where the interface was blocked whenever it stops responding "
+                             "for longer than SECONDS; 0 turns this off. Default is %.1f" %
+                             stall_detector.StallDetector.DEFAULT_THRESHOLD)
+    parser.add_argument("--stall-log", metavar="LOG_FILE", type=str,
+                        help="Append a report with the blocking stack to LOG_FILE for every stall")
+    parser.add_argument("--search", metavar="TEXT", type=str,
+                        help="List downloaded files containing TEXT and exit")
+    parser.add_argument("--reindex", action="store_true",
+                        help="Bring the search index up to date with everything already "
+                             "downloaded and exit")
+    parser.add_argument("--query", action="store_true",
+                        help="Print matching projects from --stdin or --dashboard as JSON "
+                             "lines while the dashboard is read, and exit")
+    parser.add_argument("--fields", metavar="FIELDS", type=parseFields, default=QUERY_FIELDS,
+                        help="Comma separated fields for --query. Default is all of %s" %
+                             ",".join(QUERY_FIELDS))
+    parser.add_argument("--unit", metavar="UNIT", type=str, action="append",
+                        help="Only query projects from UNIT; can be given more than once")
+    parser.add_argument("--since", metavar="DATE", type=dateutil.parser.parse,
+                        help="Only query projects submitted on or after DATE")
+    parser.add_argument("--until", metavar="DATE", type=dateutil.parser.parse,
+                        help="Only query projects submitted on or before DATE")
+    parser.add_argument("--sync-all", action="store_true",
+                        help="Download every project matching the filter and exit "
+                             "without starting the browser")
+    parser.add_argument("--jobs", metavar="N", type=int,
+                        default=download_queue.DownloadQueue.DEFAULT_WORKERS,
+                        help="Number of projects to download at once. Default is %d" %
+                             download_queue.DownloadQueue.DEFAULT_WORKERS)
+    parser.add_argument("--daemon", action="store_true",
+                        help="Run a background sync daemon that keeps download clients, "
+                             "projects and the download queue in memory")
+    parser.add_argument("--daemon-socket", metavar="SOCKET", type=str,
+                        default=sync_daemon.DEFAULT_SOCKET,
+                        help="Unix socket the daemon listens on. Default is \"%s\"" %
+                             sync_daemon.DEFAULT_SOCKET)
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="Don't attach to a running daemon")
+    parser.add_argument("--open", metavar="PROJECT", type=str,
+                        help="Ask the daemon to download and open the project matching PROJECT")
+    parser.add_argument("--copy-path", metavar="PROJECT", type=str,
+                        help="Ask the daemon to download the project matching PROJECT "
+                             "and copy its local path to the clipboard")
+    parser.add_argument("--list", metavar="QUERY", type=str, nargs="?", const="",
+                        help="List the daemon's projects, optionally matching QUERY")
 
     args = parser.parse_args()
+    daemon_command = args.open is not None or args.copy_path is not None or args.list is not None
 
     palette = DEFAULT_PALETTE
+    shell_integration.setShellSession(args.shell_session)
+    shell_integration.setMaxWorkspaces(args.max_workspaces)
+    if args.query:
+        if args.working_dir is None:
+            args.working_dir = os.path.join(os.getcwd(), "downloads")
+        project_filters = []
+        if args.hide_older_than:
+            project_filters.append(mentor_dashboard.RelativeProjectFilter(args.hide_older_than))
+        if args.since is not None or args.until is not None:
+            project_filters.append(mentor_dashboard.RangedProjectFilter(args.since, args.until))
+        if args.unit is not None:
+            project_filters.append(mentor_dashboard.UnitProjectFilter(args.unit))
+        storage_manager = storage.StorageManager(os.path.abspath(args.working_dir))
+        if args.stdin:
+            return runQuery(sys.stdin, project_filters, args.fields,
+                            os.path.abspath(args.working_dir), storage_manager)
+        if args.dashboard is None:
+            parser.error("--query requires --stdin or --dashboard")
+        with open(args.dashboard) as f:
+            return runQuery(f, project_filters, args.fields,
+                            os.path.abspath(args.working_dir), storage_manager)
     if args.stdin:
         data_source = sys.stdin.read()
-        sys.stdin = open('/dev/tty')
-        os.dup2(sys.stdin.fileno(), 0)
+        if not (args.sync_all or args.daemon or daemon_command):
+            sys.stdin = open('/dev/tty')
+            os.dup2(sys.stdin.fileno(), 0)
+    elif args.dashboard is not None:
+        with open(args.dashboard) as f:
+            data_source = f.read()
     else:
         data_source = None
 
+    if args.sync_all and data_source is None:
+        parser.error("--sync-all requires --stdin or --dashboard")
+
+    daemon = None
+    # The daemon would download on our behalf
+    if not args.daemon and not args.no_daemon and not args.offline:
+        candidate = sync_daemon.DaemonClient(args.daemon_socket)
+        if candidate.available():
+            daemon = candidate
+    if daemon_command:
+        if daemon is None:
+            parser.error("no daemon is listening on %s" % args.daemon_socket)
+        if data_source is not None:
+            daemon.load(data_source)
+        return runDaemonCommand(daemon, args)
+
     if args.hide_older_than:
         project_filter = mentor_dashboard.RelativeProjectFilter(
             days_ago=args.hide_older_than)
@@ -428,28 +1027,74 @@ def main():
 
     if args.working_dir is not None:
         args.working_dir = os.path.abspath(args.working_dir)
-
-    download_clients = {
-        "gdrive": gdrive.GdriveClient(
+    else:
+        args.working_dir = os.path.join(os.getcwd(), "downloads")
+    blob_store = blobstore.BlobStore(args.working_dir)
+    index = search_index.SearchIndex(args.working_dir)
+    storage_manager = storage.StorageManager(args.working_dir, args.disk_budget, blob_store, index)
+    if args.search is not None or args.reindex:
+        return runSearch(index, args.search, args.reindex)
+
+    download_clients = providers.ProviderRegistry((
+        ("gdrive", gdrive.GdriveClient(
                     token_file=args.gdrive_token,
-                    credentials_file=args.gdrive_credentials),
-        "github": github.GithubClient()
-    }
+                    credentials_file=args.gdrive_credentials,
+                    timeout=args.read_timeout)),
+        ("github", github.GithubClient(read_timeout=args.read_timeout)),
+        ("http", http_client.HttpClient(args.connect_timeout, args.read_timeout))
+    ))
+    download_clients["gdrive"].blob_store = blob_store
+    if args.offline:
+        # No client, so nothing can reach the network (or ask to authorize)
+        download_clients = providers.ProviderRegistry()
+
+    if args.sync_all:
+        if project_filter is None:
+            project_filter = mentor_dashboard.ProjectFilter()
+        projects = project_filter.filter(mentor_dashboard.getProjectsFromHTML(
+            data_source,
+            download_clients=download_clients,
+            working_dir=args.working_dir,
+            storage=storage_manager,
+            search_index=index,
+            offline=args.offline))
+        result = syncAll(projects, download_clients, args.jobs)
+        print("dedup: %s" % blob_store.summary())
+        return result
+
+    if args.daemon:
+        return runDaemon(args.daemon_socket, download_clients, args.working_dir,
+                         args.jobs, data_source, storage_manager, index)
+
+    if daemon is not None:
+        # Downloads go through the daemon's clients, so nothing needs to be
+        # initialized locally, and its projects are listed without parsing
+        # the dashboard again
+        download_clients = {}
 
     app = BrowserApplication(
         palette,
         download_clients=download_clients,
         project_filter=project_filter,
         working_dir=args.working_dir,
-        data_source=data_source)
+        data_source=data_source,
+        daemon=daemon,
+        max_downloads=args.jobs,
+        storage=storage_manager,
+        search_index=index,
+        references=reference_cache.ReferenceCache(args.working_dir),
+        stall_threshold=args.stall_threshold,
+        stall_log=args.stall_log,
+        offline=args.offline)
 
     try:
         app.run()
     except KeyboardInterrupt:
         pass
+    shell_integration.active_launcher.closeAll()
     shell_integration.syncShells("")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
-    sys.exit(0)
+    sys.exit(main())
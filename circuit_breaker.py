@@ -0,0 +1,88 @@
+import http.client
+import socket
+import ssl
+import threading
+import time
+
+import download_queue
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def isNetworkError(exception):
+    # Not disk errors, which are OSErrors too
+    return isinstance(exception, (ConnectionError, TimeoutError, socket.gaierror, socket.timeout,
+                                  ssl.SSLError, http.client.HTTPException))
+
+
+class CircuitBreaker(object):
+    # After FAILURE_THRESHOLD network failures in a row a provider is taken
+    # as unreachable, and its downloads fail straight away instead of each
+    # waiting out its own timeouts. After RESET_SECONDS one download is let
+    # through to find out whether it came back
+    FAILURE_THRESHOLD = 3
+    RESET_SECONDS = 30
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, name, isFailure=isNetworkError,
+                 failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS):
+        self.name = name
+        self.isFailure = isFailure
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+
+    def before(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpen("%s is unreachable (%s); trying again in %ds" % (
+                self.name, self.last_error, max(1, int(remaining))))
+
+    def succeeded(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failed(self, exception):
+        with self.lock:
+            if not self.isFailure(exception):
+                # The provider answered; whatever went wrong was the link's
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self.failures = 0
+                return
+            self.failures += 1
+            self.last_error = exception
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, function, *args, **kwargs):
+        self.before()
+        try:
+            result = function(*args, **kwargs)
+        except download_queue.DownloadCancelled:
+            with self.lock:
+                if self.state == self.HALF_OPEN:
+                    # Nothing learned; the next download gets to try instead
+                    self.state = self.OPEN
+            raise
+        except Exception as e:
+            self.failed(e)
+            raise
+        self.succeeded()
+        return result
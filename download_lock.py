@@ -0,0 +1,148 @@
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import time
+
+import download_queue
+
+LOCK_DIR = ".locks"
+
+
+class DownloadLockError(Exception):
+    pass
+
+
+class DownloadLock(object):
+    # flock()s are dropped by the kernel when their process dies, so a
+    # crashed download never leaves the lock held; its state file is what
+    # tells the next holder there is partial output to clean up
+    WAIT_POLL_SECONDS = 0.5
+    STATE_WRITE_INTERVAL = 0.5
+
+    def __init__(self, working_dir, path):
+        self.path = path
+        name = hashlib.md5(os.path.relpath(path, working_dir).encode()).hexdigest()
+        lock_dir = os.path.join(working_dir, LOCK_DIR)
+        self.lock_file = os.path.join(lock_dir, name + ".lock")
+        self.state_file = os.path.join(lock_dir, name + ".json")
+        self.fd = None
+        self.acquired = False
+        self.recovered = False
+        self.last_write = 0
+
+    def tryAcquire(self):
+        # Created 0o666 under the user's umask so mentors sharing a working
+        # dir can all take the lock; flock needs no more than read access
+        try:
+            os.makedirs(os.path.dirname(self.lock_file), mode=0o777, exist_ok=True)
+            fd = os.open(self.lock_file, os.O_RDONLY | os.O_CREAT, 0o666)
+        except PermissionError as e:
+            # Downloading without the lock could write over another
+            # process's download, so the link fails instead
+            raise DownloadLockError(
+                "Can't take the download lock in %s (%s); it has to be writable by everyone "
+                "sharing the working dir" % (os.path.dirname(self.lock_file), e.strerror))
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        self.acquired = True
+        previous = self.readState()
+        self.recovered = previous is not None and previous.get("status") == "downloading"
+        self.writeState(status="downloading", progress=0.0)
+        return True
+
+    def acquire(self, waitCallback=None, cancel_event=None):
+        # waitCallback(state) hears about the other process's download while
+        # this one waits for it
+        last_state = None
+        while not self.tryAcquire():
+            if cancel_event is not None and cancel_event.is_set():
+                raise download_queue.DownloadCancelled()
+            state = self.readState()
+            if waitCallback is not None and state is not None and state != last_state:
+                waitCallback(state)
+            last_state = state
+            time.sleep(self.WAIT_POLL_SECONDS)
+        return self
+
+    def held(self):
+        # Whether some process is downloading into path right now
+        if self.acquired:
+            return True
+        try:
+            fd = os.open(self.lock_file, os.O_RDONLY)
+        except (FileNotFoundError, PermissionError):
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def inProgress(self):
+        # Held, or left mid-download by a process that crashed
+        if self.held():
+            return True
+        state = self.readState()
+        return state is not None and state.get("status") == "downloading"
+
+    def readState(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def writeState(self, **state):
+        state.update({"pid": os.getpid(), "host": socket.gethostname(), "path": self.path,
+                      "updated": time.time()})
+        # Progress arrives from several export threads at once, so each
+        # write stages into a file of its own
+        self.last_write = time.monotonic()
+        try:
+            fd, staging = tempfile.mkstemp(dir=os.path.dirname(self.state_file),
+                                           prefix=os.path.basename(self.state_file) + ".")
+        except PermissionError:
+            # Only other processes' progress display and crash recovery
+            # read it
+            return
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(staging, self.state_file)
+        except BaseException:
+            if os.path.exists(staging):
+                os.unlink(staging)
+            raise
+
+    def progress(self, fraction):
+        if time.monotonic() - self.last_write >= self.STATE_WRITE_INTERVAL:
+            self.writeState(status="downloading", progress=fraction)
+
+    def release(self, succeeded=True):
+        if not self.acquired:
+            return
+        if succeeded:
+            self.writeState(status="done", progress=1.0)
+        else:
+            # The holder cleaned up after itself, there is nothing to recover
+            self.writeState(status="failed")
+        self.acquired = False
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release(succeeded=exc_type is None)
@@ -0,0 +1,92 @@
+import concurrent.futures
+import threading
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadQueue(object):
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, statusCallback=None):
+        self.max_workers = max_workers
+        # Called from worker threads with (project, status) as a project
+        # moves through "queued", "downloading" and "done", "failed" or
+        # "cancelled"
+        self.statusCallback = statusCallback
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="download")
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.cancel_events = {}
+
+    def submit(self, project):
+        # Requests for a project that is already queued or downloading join
+        # the existing job rather than starting a second one
+        key = project.key()
+        with self.lock:
+            future = self.in_flight.get(key)
+            # A cancelled job may still be winding down; it isn't joined
+            if future is None or self.cancel_events[key].is_set():
+                self.notify(project, "queued")
+                cancel_event = threading.Event()
+                future = self.executor.submit(self.run, project, cancel_event)
+                self.in_flight[key] = future
+                self.cancel_events[key] = cancel_event
+                future.add_done_callback(
+                    lambda done, key=key: self.finished(key, done, project))
+            return future
+
+    def run(self, project, cancel_event):
+        if cancel_event.is_set():
+            raise DownloadCancelled()
+        self.notify(project, "downloading")
+        return project.getLocalURIs(cancel_event=cancel_event)
+
+    def cancel(self, project):
+        # Pending jobs never start; running ones stop at their next chunk
+        # and clean up what they wrote
+        key = project.key()
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                return False
+            self.cancel_events[key].set()
+        future.cancel()
+        return True
+
+    def cancelAll(self):
+        with self.lock:
+            futures = list(self.in_flight.values())
+            for cancel_event in self.cancel_events.values():
+                cancel_event.set()
+        for future in futures:
+            future.cancel()
+
+    def notify(self, project, status):
+        if self.statusCallback is not None:
+            self.statusCallback(project, status)
+
+    def then(self, future, callback):
+        # Follow-up work (opening editors, walking trees) never runs on the
+        # caller's thread, even when the download has already finished
+        future.add_done_callback(
+            lambda done: threading.Thread(target=callback, args=(done,), daemon=True).start())
+
+    def finished(self, key, future, project):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+                del self.cancel_events[key]
+        if future.cancelled() or isinstance(future.exception(), DownloadCancelled):
+            self.notify(project, "cancelled")
+        else:
+            self.notify(project, "failed" if future.exception() is not None else "done")
+
+    def pending(self):
+        with self.lock:
+            return len(self.in_flight)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -1,12 +1,24 @@
+import concurrent.futures
+import datetime
 import os
 import mimetypes
 import pickle
 import re
+import shutil
+import socket
+import threading
+import time
+import google_auth_httplib2
+import httplib2
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from apiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 
+import circuit_breaker
+import download_queue
+import scheduler
 import shell_integration
 
 SRC_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -15,62 +27,364 @@ class GdriveClient(object):
     CREDENTIALS_FILE = os.path.join(SRC_DIR, 'credentials', 'gdrive_springboard_credentials.json')
     TOKEN_FILE = os.path.join(SRC_DIR, 'credentials', 'gdrive_springboard_token.pickle')
     SCOPES = ('https://www.googleapis.com/auth/drive.readonly',)
+    # Domains the provider registry routes to this client
+    HOSTS = ('google.com',)
+    METADATA_FIELDS = 'id, name, mimeType, version, size, md5Checksum, modifiedTime'
+    FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+    # Refresh this long before the access token expires, and retry this
+    # soon after a failed refresh
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+    REFRESH_RETRY_SECONDS = 60
+    # Drive accepts at most 100 calls per batch request
+    METADATA_BATCH_SIZE = 100
+    # Students keep editing after the dashboard is loaded, and exports are
+    # cached by version, so cached metadata is only trusted this long
+    METADATA_TTL = 5 * 60
+    EXPORT_CACHE_DIR = os.path.join('.cache', 'gdrive-exports')
+    EXPORT_WORKERS = 4
+    # Smaller than the client library's 100 MiB default, so a cancelled
+    # download stops within a chunk or so
+    DOWNLOAD_CHUNK_SIZE = 8 << 20
+    # 403s only mean "slow down" when they carry one of these reasons
+    RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+    PDF = 'application/pdf'
+    XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    # URL link type -> export format
+    EXPORT_TYPES = {
+        'document': PDF,
+        'spreadsheets': XLSX,
+        'presentation': PDF,
+    }
+    # Drive-native MIME type -> export format, for docs found inside folders
+    NATIVE_EXPORT_TYPES = {
+        'application/vnd.google-apps.document': PDF,
+        'application/vnd.google-apps.spreadsheet': XLSX,
+        'application/vnd.google-apps.presentation': PDF,
+    }
 
     GDRIVE_URL_PARSER = re.compile(r"(?:https?://)?"
                                    r"(?:[^.]*).google.com/(?:drive/)?"
                                    r"([A-Za-z]*)/(?:d/)?([^/?]+)")
 
-    def __init__(self, token_file=TOKEN_FILE, credentials_file=CREDENTIALS_FILE):
+    def __init__(self, token_file=TOKEN_FILE, credentials_file=CREDENTIALS_FILE, timeout=None):
         self.token_file = token_file
         self.credentials_file = credentials_file
+        # httplib2 applies one timeout to connecting and to every read
+        self.timeout = timeout
+        self.breaker = circuit_breaker.CircuitBreaker("Google Drive", self.isOutage)
         self.creds = None
-        self.service = None
+        self.thread_state = threading.local()
+        self.metadata_cache = {}
+        self.metadata_lock = threading.Lock()
+        self.blob_store = None
+        self.init_lock = threading.Lock()
+        self.refresh_timer = None
+        self.scheduler = scheduler.RequestScheduler(self.classifyError)
+        # Shared by every download, so exports stay at EXPORT_WORKERS threads
+        # (each with its own service object) however many projects and links
+        # are downloading
+        self.export_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.EXPORT_WORKERS, thread_name_prefix="gdrive-export")
 
     def matchURL(self, url):
         return self.GDRIVE_URL_PARSER.match(url) is not None
 
     def initialized(self):
-        return self.service is not None
+        return self.creds is not None
+
+    @property
+    def service(self):
+        # httplib2 connections are not thread-safe, so every download thread
+        # builds its own service object on top of the shared credentials
+        if self.creds is None:
+            return None
+        service = getattr(self.thread_state, "service", None)
+        if service is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.creds, http=httplib2.Http(timeout=self.timeout))
+            service = build('drive', 'v3', http=http)
+            self.thread_state.service = service
+        return service
 
     def initialize(self, attemptAuthorization=True):
         # TODO: cursify using https://google-auth-oauthlib.readthedocs.io/en/latest/reference/google_auth_oauthlib.flow.html
-        self.creds = None
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'rb') as token:
-                self.creds = pickle.load(token)
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+        with self.init_lock:
+            if self.initialized():
+                return True
+            creds = None
+            if os.path.exists(self.token_file):
+                with open(self.token_file, 'rb') as token:
+                    creds = pickle.load(token)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    if attemptAuthorization is False:
+                        return False
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        self.credentials_file, self.SCOPES)
+                    creds = flow.run_local_server(port=0)
+                self.saveToken(creds)
+            self.creds = creds
+            self.thread_state = threading.local()
+            self.scheduleRefresh()
+            return True
+
+    def initializeInBackground(self, completionCallback=None):
+        # Loading and refreshing the token happens at startup rather than
+        # when the first project is selected
+        def body():
+            try:
+                success = self.initialize(attemptAuthorization=False)
+            except Exception:
+                success = False
+            if success and completionCallback is not None:
+                completionCallback()
+        threading.Thread(target=body, daemon=True).start()
+
+    def saveToken(self, creds):
+        staging = "%s.%d" % (self.token_file, os.getpid())
+        with open(staging, 'wb') as token:
+            pickle.dump(creds, token)
+        os.replace(staging, self.token_file)
+
+    def scheduleRefresh(self, delay=None):
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+        if not self.creds.refresh_token:
+            return
+        if delay is None:
+            if self.creds.expiry is None:
+                return
+            # google-auth keeps expiry as a naive UTC datetime
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            delay = max(0, (self.creds.expiry - self.REFRESH_MARGIN - now).total_seconds())
+        self.refresh_timer = threading.Timer(delay, self.refreshCredentials)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def refreshCredentials(self):
+        # Refreshing in place updates the token every thread's service
+        # already holds, so no connection ever has to be rebuilt
+        try:
+            self.creds.refresh(Request())
+            self.saveToken(self.creds)
+        except Exception:
+            self.scheduleRefresh(self.REFRESH_RETRY_SECONDS)
+            return
+        self.scheduleRefresh()
+
+    @classmethod
+    def classifyError(cls, exception):
+        if isinstance(exception, HttpError):
+            status = exception.resp.status
+            if status == 429 or (status == 403 and any(
+                    reason in (exception.content or b'') for reason in cls.RATE_LIMIT_REASONS)):
+                return scheduler.RequestScheduler.THROTTLED
+            if status >= 500:
+                return scheduler.RequestScheduler.TRANSIENT
+            return None
+        if isinstance(exception, (ConnectionError, socket.timeout)):
+            return scheduler.RequestScheduler.TRANSIENT
+        return None
+
+    @classmethod
+    def isOutage(cls, exception):
+        # Still failing after the scheduler's retries
+        return (cls.classifyError(exception) is not None or
+                isinstance(exception, httplib2.ServerNotFoundError) or
+                circuit_breaker.isNetworkError(exception))
+
+    def breakerFor(self, url):
+        return self.breaker
+
+    def parseURL(self, url):
+        match = self.GDRIVE_URL_PARSER.match(url)
+        if match is None:
+            return None
+        return match.group(1), match.group(2)
+
+    def cacheMetadata(self, files):
+        now = time.monotonic()
+        with self.metadata_lock:
+            for file in files:
+                self.metadata_cache[file["id"]] = (now, dict(file))
+
+    def cachedMetadata(self, file_id):
+        with self.metadata_lock:
+            entry = self.metadata_cache.get(file_id)
+        if entry is None or time.monotonic() - entry[0] > self.METADATA_TTL:
+            return None
+        # Callers annotate metadata with local paths, so hand out copies
+        return dict(entry[1])
+
+    def getMetadata(self, file_id, refresh=False):
+        metadata = None if refresh else self.cachedMetadata(file_id)
+        if metadata is None:
+            metadata = self.scheduler.execute(
+                self.service.files().get(fileId=file_id, fields=self.METADATA_FIELDS))
+            self.cacheMetadata([metadata])
+        return metadata
+
+    def revision(self, url):
+        # Drive bumps a file's version on every change
+        parsed = self.parseURL(url)
+        if parsed is None:
+            return None
+        return self.getMetadata(parsed[1], refresh=True).get("version")
+
+    def prefetchMetadata(self, urls):
+        if self.service is None:
+            raise Exception("GDrive service not initialized")
+
+        file_ids = []
+        for url in urls:
+            parsed = self.parseURL(url)
+            if parsed is not None and parsed[1] not in file_ids:
+                file_ids.append(parsed[1])
+        # Expired entries are fetched again, so each sync pass refreshes them
+        file_ids = [file_id for file_id in file_ids if self.cachedMetadata(file_id) is None]
+
+        fetched = {}
+        failed = {}
+
+        def store(request_id, response, exception):
+            # Links we can't read fail individually and are fetched (and
+            # reported) again when downloaded
+            if exception is None:
+                fetched[request_id] = response
             else:
-                if attemptAuthorization is False:
-                    return False
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, self.SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            with open(self.token_file, 'wb') as token:
-                pickle.dump(self.creds, token)
-        self.service = build('drive', 'v3', credentials=self.creds)
-        return True
-
-    def downloadGDriveFile(self, file_id, local_path, exportMIMEType=None, metadata=None, progressCallback=None):
+                outcome = self.classifyError(exception)
+                if outcome is not None:
+                    failed[request_id] = outcome
+
+        attempt = 0
+        while len(file_ids) > 0:
+            for start in range(0, len(file_ids), self.METADATA_BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=store)
+                for file_id in file_ids[start:start + self.METADATA_BATCH_SIZE]:
+                    batch.add(self.service.files().get(fileId=file_id, fields=self.METADATA_FIELDS),
+                              request_id=file_id)
+                self.scheduler.execute(batch)
+            # Rate limited and transient failures inside the batch get the
+            # same backoff and retries as whole requests
+            retrying = attempt < self.scheduler.MAX_RETRIES
+            for outcome in failed.values():
+                self.scheduler.recordFailure(outcome, retrying)
+            file_ids = list(failed) if retrying else []
+            failed.clear()
+            if len(file_ids) > 0:
+                time.sleep(self.scheduler.backoff(attempt))
+                attempt += 1
+        self.cacheMetadata(fetched.values())
+        return len(fetched)
+
+    @staticmethod
+    def checkCancelled(cancel_event):
+        if cancel_event is not None and cancel_event.is_set():
+            raise download_queue.DownloadCancelled()
+
+    def downloadRequest(self, content_request, filename, metadata, progressCallback=None,
+                        cancel_event=None):
+        with open(filename, "wb") as f:
+            self.downloadToStream(content_request, f, metadata, progressCallback, cancel_event)
+
+    def downloadToStream(self, content_request, stream, metadata, progressCallback=None,
+                         cancel_event=None):
+        downloader = MediaIoBaseDownload(stream, content_request, chunksize=self.DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while done is False:
+            self.checkCancelled(cancel_event)
+            # A failed chunk is requested again from the same offset
+            status, done = self.scheduler.call(downloader.next_chunk)
+            if progressCallback is not None:
+                progressCallback(metadata, status.progress())
+
+    def downloadGDriveFile(self, file_id, local_path, exportMIMEType=None, metadata=None,
+                           progressCallback=None, export_cache_dir=None, cancel_event=None):
         if self.service is None:
             raise Exception("GDrive service not initialized")
 
         if metadata is None:
-            metadata = self.service.files().get(fileId=file_id).execute()
+            metadata = self.getMetadata(file_id)
+        if exportMIMEType is None and metadata.get("mimeType") in self.NATIVE_EXPORT_TYPES:
+            exportMIMEType = self.NATIVE_EXPORT_TYPES[metadata["mimeType"]]
+        if exportMIMEType is not None:
+            return self.exportGDriveFile(
+                file_id, local_path, exportMIMEType, metadata=metadata,
+                progressCallback=progressCallback, export_cache_dir=export_cache_dir,
+                cancel_event=cancel_event)
+
         filename = os.path.join(local_path, metadata["name"])
-        if exportMIMEType is None:
+        checksum = metadata.get("md5Checksum")
+        if self.blob_store is not None and self.blob_store.linkInto(checksum, filename) is not None:
+            # Starter code and course datasets show up in many submissions
+            if progressCallback is not None:
+                progressCallback(metadata, 1.0)
+        elif shell_integration.isStreamableArchive(filename):
+            # Tarballs are unpacked straight off the wire instead of being
+            # written out whole and then read back
+            extract_dir = shell_integration.extractDirFor(filename)
             content_request = self.service.files().get_media(fileId=file_id)
+            with shell_integration.StreamingExtractor(extract_dir) as extractor:
+                self.downloadToStream(content_request, extractor, metadata, progressCallback,
+                                      cancel_event)
+            if self.blob_store is not None:
+                # The tarball itself never touches the disk, its members do
+                self.blob_store.ingestTree(extract_dir)
+            metadata["local_uri"] = extract_dir
+            return metadata
         else:
+            content_request = self.service.files().get_media(fileId=file_id)
+            self.downloadRequest(content_request, filename, metadata, progressCallback, cancel_event)
+            if self.blob_store is not None:
+                self.blob_store.ingest(filename, checksum)
+        if shell_integration.archiveExtension(filename) is not None:
+            extract_dir = shell_integration.extractArchive(filename)
+            if self.blob_store is not None:
+                self.blob_store.ingestTree(extract_dir)
+        metadata["local_uri"] = filename
+        return metadata
+
+    def exportGDriveFile(self, file_id, local_path, exportMIMEType, metadata=None,
+                         progressCallback=None, export_cache_dir=None, cancel_event=None):
+        if self.service is None:
+            raise Exception("GDrive service not initialized")
+
+        if metadata is None or "version" not in metadata:
+            metadata = self.getMetadata(file_id)
+        extension = mimetypes.guess_extension(exportMIMEType)
+        filename = os.path.join(local_path, metadata["name"] + extension)
+
+        def export(target):
             content_request = self.service.files().export_media(fileId=file_id, mimeType=exportMIMEType)
-            filename += mimetypes.guess_extension(exportMIMEType)
-        with open(os.path.join(local_path, filename), "wb") as f:
-            downloader = MediaIoBaseDownload(f, content_request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if progressCallback is not None:
-                    progressCallback(metadata, status.progress())
+            self.downloadRequest(content_request, target, metadata, progressCallback, cancel_event)
+
+        if export_cache_dir is None:
+            export(filename)
+        else:
+            # Exports are keyed by the file's version, which Drive bumps on
+            # every edit, so an unchanged doc is only ever exported once
+            cached = os.path.join(export_cache_dir, "%s.%s%s" % (file_id, metadata["version"], extension))
+            if not os.path.exists(cached):
+                os.makedirs(export_cache_dir, exist_ok=True)
+                staging = "%s.%d.part" % (cached, threading.get_ident())
+                try:
+                    export(staging)
+                except BaseException:
+                    if os.path.exists(staging):
+                        os.unlink(staging)
+                    raise
+                os.replace(staging, cached)
+            elif progressCallback is not None:
+                progressCallback(metadata, 1.0)
+            # A copy rather than a link, so editing the export in one project
+            # leaves the cache (and every other project) alone. Unlinked
+            # first in case it is a link made before
+            if os.path.lexists(filename):
+                os.unlink(filename)
+            shutil.copyfile(cached, filename)
         metadata["local_uri"] = filename
         return metadata
 
@@ -83,18 +397,20 @@ class GdriveClient(object):
 
         response_files = []
         while True:
-            response = self.service.files().list(
+            response = self.scheduler.execute(self.service.files().list(
                 q="'%s' in parents" % dir_id,
                 spaces='drive',
                 pageSize=100,
-                fields='nextPageToken, files(name, mimeType, id)',
+                fields='nextPageToken, files(%s)' % self.METADATA_FIELDS,
                 pageToken=page_token
-            ).execute()
+            ))
             page_token = response.get('nextPageToken', None)
             response_files.extend(response.get('files', []))
             if page_token is None:
                 break
 
+        self.cacheMetadata(response_files)
+
         for file in response_files:
             if file["mimeType"].endswith("folder"):
                 file["contents"] = self.getGDriveTree(file["id"])
@@ -103,29 +419,56 @@ class GdriveClient(object):
                 directory["files"].append(file)
         return directory
 
-    def downloadGdriveFolder(self, dir_id, cwd, progressCallback=None):
+    def downloadGdriveFolder(self, dir_id, cwd, progressCallback=None, export_cache_dir=None,
+                             cancel_event=None):
         if self.service is None:
             raise Exception("GDrive service not initialized")
 
         directory_tree = self.getGDriveTree(dir_id)
 
+        # Exports are by far the slowest calls Drive serves, so the folder's
+        # native docs are exported concurrently while the rest download
+        exports = []
+
         def dir_helper(dir_contents, local_path):
             for file in dir_contents["files"]:
+                if file["mimeType"] in self.NATIVE_EXPORT_TYPES:
+                    exports.append((file, local_path))
+                    continue
+                self.checkCancelled(cancel_event)
                 self.downloadGDriveFile(
                     file["id"],
                     metadata=file,
                     local_path=local_path,
-                    progressCallback=progressCallback)
+                    progressCallback=progressCallback,
+                    cancel_event=cancel_event)
             for directory in dir_contents["dirs"].values():
                 subdir_path = os.path.join(local_path, directory["name"])
                 directory["local_uri"] = subdir_path
                 os.makedirs(subdir_path, exist_ok=True)
                 dir_helper(directory["contents"], subdir_path)
         dir_helper(directory_tree, cwd)
+        self.exportConcurrently(exports, progressCallback, export_cache_dir, cancel_event)
         directory_tree["local_uri"] = cwd
         return directory_tree
 
-    def downloadURL(self, url, cwd=os.getcwd(), dirname=None, progressCallback=None):
+    def exportConcurrently(self, exports, progressCallback=None, export_cache_dir=None,
+                           cancel_event=None):
+        if len(exports) == 0:
+            return
+        jobs = [self.export_executor.submit(
+            self.exportGDriveFile, file["id"], local_path,
+            self.NATIVE_EXPORT_TYPES[file["mimeType"]], metadata=file,
+            progressCallback=progressCallback, export_cache_dir=export_cache_dir,
+            cancel_event=cancel_event)
+            for file, local_path in exports]
+        # Nothing of this folder is still being written when we return
+        concurrent.futures.wait(jobs)
+        for job in jobs:
+            job.result()
+
+    def downloadURL(self, url, cwd=os.getcwd(), dirname=None, progressCallback=None,
+                    cancel_event=None):
         if self.service is None:
             raise Exception("GDrive service not initialized")
         result = None
@@ -139,23 +482,42 @@ class GdriveClient(object):
             base_dir = os.path.join(cwd, dirname)
             os.makedirs(base_dir, exist_ok=True)
             shell_integration.makeURLShortcut(url, base_dir, "Drive Link", "Link to original file source")
+            export_cache_dir = os.path.join(cwd, self.EXPORT_CACHE_DIR)
+
+            # Prefetched metadata knows what the link really points at, which
+            # beats guessing from the URL and saves the per-file lookup
+            metadata = self.cachedMetadata(gdrive_id)
+            if metadata is not None:
+                if metadata["mimeType"] == self.FOLDER_MIME_TYPE:
+                    link_type = "folders"
+                else:
+                    # downloadGDriveFile exports native docs by MIME type
+                    link_type = "file"
 
             if link_type == "file":
                 result = {"local_uri": base_dir, "dirs": {}, "files": [
                     self.downloadGDriveFile(
                         gdrive_id, base_dir,
-                        progressCallback=progressCallback)
+                        metadata=metadata,
+                        progressCallback=progressCallback,
+                        export_cache_dir=export_cache_dir,
+                        cancel_event=cancel_event)
                 ]}
             elif link_type == "folders":
                 result = self.downloadGdriveFolder(
                     gdrive_id, base_dir,
-                    progressCallback=progressCallback)
-            elif link_type == "document":
+                    progressCallback=progressCallback,
+                    export_cache_dir=export_cache_dir,
+                    cancel_event=cancel_event)
+            elif link_type in self.EXPORT_TYPES:
                 result = {"local_uri": base_dir, "dirs": {}, "files": [
-                    self.downloadGDriveFile(
+                    self.exportGDriveFile(
                         gdrive_id, base_dir,
-                        exportMIMEType='application/pdf',
-                        progressCallback=progressCallback)
+                        self.EXPORT_TYPES[link_type],
+                        metadata=metadata,
+                        progressCallback=progressCallback,
+                        export_cache_dir=export_cache_dir,
+                        cancel_event=cancel_event)
                 ]}
             else:
                 raise ValueError("Invalid Google Drive URL '%s'" % url)
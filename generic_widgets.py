@@ -1,5 +1,7 @@
 import time
 import os
+import queue
+import threading
 
 import urwid
 
@@ -89,7 +91,7 @@ class PopupDialog(urwid.Overlay):
 class WaitDialog(PopupDialog):
     ANIMATION_SPEED = 0.1
     SPINNER = r"/-\|/-\|"
-    def __init__(self, loop, text, attach=True, threadable=False):
+    def __init__(self, loop, text, attach=True, threadable=False, cancelable=False):
         self.spinner = spinner()
         self.spinner_widget = urwid.Text(next(self.spinner))
         self.label = urwid.Text(text)
@@ -98,7 +100,7 @@ class WaitDialog(PopupDialog):
             ('pack',self.spinner_widget),
             self.label
         )), 'middle')
-        super().__init__(loop, dialog, attach, 40, 4, cancelable=False, threadable=threadable)
+        super().__init__(loop, dialog, attach, 40, 4, cancelable=cancelable, threadable=threadable)
 
     def get_text(self, *args, **kwargs):
         return self.label.get_text(*args, **kwargs)
@@ -138,6 +140,52 @@ class WaitDialog(PopupDialog):
         return None
 
 
+class MessageDialog(PopupDialog):
+    def __init__(self, loop, text, attach=True, width=50):
+        ok_button = HighlightableListRow(urwid.Text("[Ok]"))
+        urwid.connect_signal(ok_button, 'click', self.detach)
+        urwid.connect_signal(ok_button, 'doubleclick', self.detach)
+        widget = urwid.Pile((
+            urwid.Text(text + "\n"),
+            ok_button
+        ))
+        super().__init__(loop, widget, attach, width)
+
+
+class LoopDispatcher(object):
+    # Runs callables on the urwid thread on behalf of worker threads. get()
+    # sets up a pipe on the loop, so the first call for a loop has to come
+    # from the urwid thread
+    dispatchers = {}
+    lock = threading.Lock()
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = queue.Queue()
+        self.pipe = loop.watch_pipe(self.dispatch)
+
+    @classmethod
+    def get(cls, loop):
+        with cls.lock:
+            if loop not in cls.dispatchers:
+                cls.dispatchers[loop] = cls(loop)
+            return cls.dispatchers[loop]
+
+    def call(self, callback, *args, **kwargs):
+        self.pending.put((callback, args, kwargs))
+        os.write(self.pipe, b"\n")
+
+    def dispatch(self, data):
+        while True:
+            try:
+                callback, args, kwargs = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args, **kwargs)
+        self.loop.draw_screen()
+        return True
+
+
 class DoubleClickable(object):
     DOUBLE_CLICK_SPEED = 0.3
 
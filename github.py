@@ -1,17 +1,41 @@
 import os
+import posixpath
 import re
+import signal
+import subprocess
+import urllib.parse
 import git
 
-# https://github.com/(user)/(repo)/tree/(branch)
+import circuit_breaker
+import download_queue
+
+# https://github.com/(user)/(repo)/tree/(branch)/(path)
 #
 # git@github.com:(user)/(repo).git
 # git checkout (branch)
 class GithubClient(object):
     GITHUB_URL_PARSER = re.compile(r"(?:https?://)?"
                                r"(?:[^.]*).github.com/(.*)")
+    CANCEL_POLL_SECONDS = 0.2
+    HOSTS = ("github.com",)
+    # git messages that mean GitHub couldn't be reached, rather than that the
+    # repo or branch doesn't exist
+    NETWORK_FAILURES = ("Could not resolve host", "Failed to connect", "timed out",
+                        "Operation too slow", "Connection reset", "unable to access")
+
+    def __init__(self, read_timeout=None):
+        # Transfers slower than 1 KiB/s for read_timeout seconds are aborted
+        self.read_timeout = read_timeout
+        self.breaker = circuit_breaker.CircuitBreaker("GitHub", self.isOutage)
 
-    def __init__(self):
-        pass
+    @classmethod
+    def isOutage(cls, exception):
+        if isinstance(exception, git.GitCommandError):
+            return any(failure in str(exception.stderr) for failure in cls.NETWORK_FAILURES)
+        return circuit_breaker.isNetworkError(exception)
+
+    def breakerFor(self, url):
+        return self.breaker
 
     def matchURL(self, url):
         return self.GITHUB_URL_PARSER.match(url) is not None
@@ -22,10 +46,15 @@ class GithubClient(object):
     def initialize(self, attemptAuthorization=True):
         return True
 
-    def downloadURL(self, url, cwd=os.getcwd(), dirname=None, progressCallback=None):
-        url_components = GithubClient.GITHUB_URL_PARSER.match(url).group(1).split("/")
+    def parseURL(self, url):
+        path = GithubClient.GITHUB_URL_PARSER.match(url).group(1)
+        path = urllib.parse.urlsplit(path).path
+        url_components = [urllib.parse.unquote(component)
+                          for component in path.split("/") if component != ""]
         user = url_components[0]
         repo = url_components[1]
+        if repo.endswith(".git"):
+            repo = repo[:-len(".git")]
         try:
             retrieval_type = url_components[2]
         except IndexError:
@@ -34,18 +63,76 @@ class GithubClient(object):
             branch = url_components[3]
         except IndexError:
             branch = "master"
+        subpath = "/".join(url_components[4:])
+        if retrieval_type == "blob":
+            # Links to a single file check out the folder holding it
+            subpath = posixpath.dirname(subpath)
+        return user, repo, retrieval_type, branch, subpath
+
+    def revision(self, url):
+        # None when the branch doesn't exist
+        user, repo, retrieval_type, branch, subpath = self.parseURL(url)
+        heads = self.breaker.call(self.runGit, None, None, "ls-remote",
+                                  "https://github.com/%s/%s.git" % (user, repo), branch, capture=True)
+        if heads.strip() == "":
+            return None
+        return heads.split()[0]
+
+    def localURI(self, url, base_dir):
+        subpath = self.parseURL(url)[4]
+        if subpath == "":
+            return base_dir
+        return os.path.join(base_dir, *subpath.split("/"))
+
+    def runGit(self, base_dir, cancel_event, *args, capture=False):
+        # Run as a killable child (with its own session, so the transport
+        # helpers git forks go too) instead of through GitPython. Returns
+        # git's output when capture is set
+        options = ()
+        if self.read_timeout is not None:
+            options = ("-c", "http.lowSpeedLimit=1024", "-c", "http.lowSpeedTime=%d" % self.read_timeout)
+        # Private or mistyped repos would otherwise wait on a password prompt
+        # nobody can see
+        environment = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        process = subprocess.Popen(
+            ("git",) + options + args, cwd=base_dir, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL, stderr=subprocess.PIPE,
+            start_new_session=True, env=environment)
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=self.CANCEL_POLL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    os.killpg(process.pid, signal.SIGTERM)
+                    process.wait()
+                    raise download_queue.DownloadCancelled()
+        if process.returncode != 0:
+            raise git.GitCommandError(("git",) + args, process.returncode, stderr)
+        if capture:
+            return stdout.decode(errors="replace")
+
+    def downloadURL(self, url, cwd=os.getcwd(), dirname=None, progressCallback=None,
+                    cancel_event=None):
+        user, repo, retrieval_type, branch, subpath = self.parseURL(url)
 
         if dirname is None:
             dirname = "%s.%s.%s.git" % (user, repo, branch)
 
         base_dir = os.path.join(cwd, dirname)
-        git_url = "git://github.com/%s/%s.git" % (user, repo)
+        # GitHub no longer serves the unauthenticated git:// protocol
+        git_url = "https://github.com/%s/%s.git" % (user, repo)
 
         os.makedirs(base_dir, exist_ok=True)
 
-        gitDriver = git.Git(base_dir)
-        gitDriver.clone(git_url, ".")
-        gitDriver.checkout(branch)
+        if subpath == "":
+            self.runGit(base_dir, cancel_event, "clone", git_url, ".")
+        else:
+            # Monorepo links only fetch and check out the linked subtree
+            self.runGit(base_dir, cancel_event, "clone", "--filter=blob:none", "--no-checkout", git_url, ".")
+            self.runGit(base_dir, cancel_event, "sparse-checkout", "init", "--cone")
+            self.runGit(base_dir, cancel_event, "sparse-checkout", "set", subpath)
+        self.runGit(base_dir, cancel_event, "checkout", branch)
 
         # TODO: what goes in the dirs and files keys again?
-        return {"local_uri": base_dir, "dirs": {}, "files": []}
+        return {"local_uri": self.localURI(url, base_dir), "dirs": {}, "files": []}
@@ -0,0 +1,266 @@
+import email.message
+import http.client
+import os
+import posixpath
+import re
+import threading
+import urllib.parse
+
+import circuit_breaker
+import download_queue
+import shell_integration
+
+
+class HTTPDownloadError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    # Keep-alive connections per (scheme, host, port), so the many files a
+    # dashboard links on one host share a handful of TCP/TLS handshakes
+    MAX_IDLE_PER_HOST = 4
+
+    def __init__(self, connect_timeout=None, read_timeout=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return self.connect(scheme, host, port)
+
+    def connect(self, scheme, host, port):
+        connection_type = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        connection = connection_type(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        # Connecting and waiting on data get separate limits
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def release(self, scheme, host, port, connection):
+        # Only connections whose last response was read to the end can be
+        # reused
+        key = (scheme, host, port)
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.MAX_IDLE_PER_HOST:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def closeAll(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class HttpClient(object):
+    # Serves any http(s) link no other client claims
+    HOSTS = None
+    USER_AGENT = "springboard-mentor-shell"
+    CHUNK_SIZE = 1 << 16
+    MAX_REDIRECTS = 5
+    MAX_RESUMES = 5
+    DEFAULT_CONNECT_TIMEOUT = 10
+    DEFAULT_READ_TIMEOUT = 60
+    DEFAULT_FILENAME = "download"
+    CONTENT_RANGE_PARSER = re.compile(r"^\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$")
+
+    HTTP_URL_PARSER = re.compile(r"^(?:https?://)?[A-Za-z0-9.-]+\.[A-Za-z]{2,}(?::\d+)?(?:[/?#].*)?$")
+    # Share pages whose files live at a different URL
+    NBVIEWER_GITHUB_PARSER = re.compile(
+        r"^(?:https?://)?nbviewer\.(?:jupyter\.)?org/github/([^/]+)/([^/]+)/blob/(.+)$")
+    NBVIEWER_URL_PARSER = re.compile(r"^(?:https?://)?nbviewer\.(?:jupyter\.)?org/urls?/(.+)$")
+    COLAB_GITHUB_PARSER = re.compile(
+        r"^(?:https?://)?colab\.research\.google\.com/github/([^/]+)/([^/]+)/blob/(.+)$")
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool = ConnectionPool(connect_timeout, read_timeout)
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def matchURL(self, url):
+        return self.HTTP_URL_PARSER.match(url) is not None
+
+    def initialized(self):
+        return True
+
+    def initialize(self, attemptAuthorization=True):
+        return True
+
+    def breakerFor(self, url):
+        # One unreachable host says nothing about the others
+        host = urllib.parse.urlsplit(self.resolveURL(url)).hostname
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = circuit_breaker.CircuitBreaker(host)
+            return self.breakers[host]
+
+    def resolveURL(self, url):
+        match = self.NBVIEWER_GITHUB_PARSER.match(url) or self.COLAB_GITHUB_PARSER.match(url)
+        if match is not None:
+            return "https://raw.githubusercontent.com/%s/%s/%s" % match.groups()
+        match = self.NBVIEWER_URL_PARSER.match(url)
+        if match is not None:
+            return "https://" + match.group(1)
+        if "://" not in url:
+            url = "https://" + url
+        parts = urllib.parse.urlsplit(url)
+        if (parts.hostname or "").endswith("dropbox.com"):
+            # dl=1 serves the file itself instead of the preview page
+            query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query)
+                     if key != "dl"] + [("dl", "1")]
+            url = urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+        return url
+
+    def request(self, url, headers):
+        # Returns the response (and what to give back to the pool) once
+        # redirects are followed
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            connection = self.pool.acquire(parts.scheme, parts.hostname, port)
+            try:
+                connection.request("GET", target, headers=dict(headers, **{
+                    "User-Agent": self.USER_AGENT, "Connection": "keep-alive"}))
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if isinstance(e, TimeoutError):
+                    # The host is slow, not the connection stale
+                    raise
+                # A pooled connection the server already closed; retried once
+                # on a new one, as the next idle one may be just as stale
+                connection = self.pool.connect(parts.scheme, parts.hostname, port)
+                connection.request("GET", target, headers=dict(headers, **{
+                    "User-Agent": self.USER_AGENT, "Connection": "keep-alive"}))
+                response = connection.getresponse()
+            pool_key = (parts.scheme, parts.hostname, port, connection)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                self.pool.release(*pool_key)
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            return url, response, pool_key
+        raise HTTPDownloadError("Too many redirects fetching %s" % url)
+
+    def filenameFor(self, url, response):
+        disposition = response.getheader("Content-Disposition")
+        if disposition is not None:
+            message = email.message.Message()
+            message["Content-Disposition"] = disposition
+            filename = message.get_filename()
+            if filename:
+                return os.path.basename(filename)
+        filename = posixpath.basename(urllib.parse.unquote(urllib.parse.urlsplit(url).path))
+        return filename or self.DEFAULT_FILENAME
+
+    def downloadFile(self, url, local_path, progressCallback=None, cancel_event=None):
+        staging = None
+        filename = None
+        written = 0
+        total = None
+        validator = None
+        metadata = {"name": None, "size": None}
+        for attempt in range(self.MAX_RESUMES + 1):
+            resumed_from = written
+            headers = {}
+            if written > 0 and validator is not None:
+                # Pick up where the interrupted transfer stopped, unless the
+                # file changed in between. Without an ETag or Last-Modified
+                # there is no telling, so the file is fetched again whole
+                headers["Range"] = "bytes=%d-" % written
+                headers["If-Range"] = validator
+            connection = None
+            try:
+                final_url, response, pool_key = self.request(url, headers)
+                connection = pool_key[3]
+                if response.status >= 400:
+                    raise HTTPDownloadError("HTTP %d fetching %s" % (response.status, final_url))
+                if filename is None:
+                    filename = os.path.join(local_path, self.filenameFor(final_url, response))
+                    staging = filename + ".part"
+                    metadata["name"] = os.path.basename(filename)
+                if response.status == 206:
+                    match = self.CONTENT_RANGE_PARSER.match(response.getheader("Content-Range") or "")
+                    if (match is None or int(match.group(1)) != written or
+                            (total is not None and match.group(3) != str(total))):
+                        # Not the range we asked for, or a range of a file
+                        # that changed size; appending it would corrupt the
+                        # file, so start over from the top
+                        connection.close()
+                        connection = None
+                        written = 0
+                        validator = None
+                        continue
+                    mode = "ab"
+                else:
+                    # A full response, either first time or because the
+                    # server can't or won't resume
+                    mode = "wb"
+                    written = 0
+                    length = response.getheader("Content-Length")
+                    total = int(length) if length is not None else None
+                    metadata["size"] = total
+                validator = response.getheader("ETag") or response.getheader("Last-Modified")
+                with open(staging, mode) as f:
+                    while True:
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise download_queue.DownloadCancelled()
+                        chunk = response.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        written += len(chunk)
+                        if progressCallback is not None and total:
+                            progressCallback(metadata, min(1.0, written / float(total)))
+                if total is not None and written < total:
+                    raise http.client.IncompleteRead(b"", total - written)
+                self.pool.release(*pool_key)
+                break
+            except (http.client.HTTPException, OSError) as e:
+                if connection is not None:
+                    connection.close()
+                if attempt == self.MAX_RESUMES:
+                    raise
+                if isinstance(e, TimeoutError) and written == resumed_from:
+                    # Nothing arrived before the read timeout; resuming would
+                    # only wait it out again
+                    raise
+            except BaseException:
+                if connection is not None:
+                    connection.close()
+                raise
+        else:
+            raise HTTPDownloadError("Could not resume %s at byte %d" % (url, written))
+        os.replace(staging, filename)
+        if progressCallback is not None:
+            progressCallback(metadata, 1.0)
+        metadata["local_uri"] = filename
+        return metadata
+
+    def downloadURL(self, url, cwd=os.getcwd(), dirname=None, progressCallback=None,
+                    cancel_event=None):
+        resolved_url = self.resolveURL(url)
+        if dirname is None:
+            dirname = shell_integration.sanitizeFilesystemName(urllib.parse.urlsplit(resolved_url).hostname)
+        base_dir = os.path.join(cwd, dirname)
+        os.makedirs(base_dir, exist_ok=True)
+        shell_integration.makeURLShortcut(url, base_dir, "Link", "Link to original file source")
+        try:
+            downloaded = self.downloadFile(resolved_url, base_dir, progressCallback, cancel_event)
+        except BaseException:
+            for name in os.listdir(base_dir):
+                if name.endswith(".part"):
+                    os.unlink(os.path.join(base_dir, name))
+            raise
+        return {"local_uri": base_dir, "dirs": {}, "files": [downloaded]}
@@ -0,0 +1,166 @@
+import collections
+import shutil
+import subprocess
+import threading
+import time
+
+
+def listWindows(window_class):
+    # Window ids of one application, as the window manager sees them
+    try:
+        output = subprocess.run(["wmctrl", "-lx"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    windows = set()
+    for line in output.decode(errors="replace").splitlines():
+        fields = line.split(None, 3)
+        if len(fields) >= 3 and window_class.lower() in fields[2].lower():
+            windows.add(fields[0])
+    return windows
+
+
+class Window(object):
+    # A window some other process (a running Sublime) opened for us. Closing
+    # asks the window manager, the way clicking its close button would, so
+    # the app can still ask about unsaved changes
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = []
+        self.closed = False
+
+    def adopt(self, window_ids):
+        with self.lock:
+            if not self.closed:
+                self.ids.extend(window_ids)
+                return
+        # Closed before the window showed up
+        self.closeIds(window_ids)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            window_ids, self.ids = self.ids, []
+        self.closeIds(window_ids)
+
+    @staticmethod
+    def closeIds(window_ids):
+        for window_id in window_ids:
+            subprocess.run(["wmctrl", "-i", "-c", window_id], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class Launcher(object):
+    DEFAULT_MAX_WORKSPACES = 3
+    TERMINATE_TIMEOUT = 2
+    # How long a window handed to another app has to show up
+    WINDOW_TIMEOUT = 10
+    WINDOW_POLL_INTERVAL = 0.2
+
+    def __init__(self, max_workspaces=DEFAULT_MAX_WORKSPACES):
+        self.max_workspaces = max_workspaces
+        self.lock = threading.RLock()
+        # owner -> processes and windows, least recently opened first
+        self.workspaces = collections.OrderedDict()
+        self.untracked = []
+        # Only one window is waited for at a time, so each new window is
+        # credited to the right owner
+        self.window_lock = threading.Lock()
+
+    def spawn(self, argv, owner=None):
+        # Children get their own session so the terminal's ^C and hangup
+        # never reach them. Closing a workspace only ever signals the
+        # processes spawned here: whatever they forked or handed the files
+        # to (a running editor, a viewer xdg-open started) may be holding
+        # the user's other windows too
+        process = subprocess.Popen(
+            argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+        if owner is None:
+            with self.lock:
+                self.reap()
+                self.untracked.append(process)
+            return process
+        self.track(owner, process)
+        return process
+
+    def spawnWindow(self, argv, owner, window_class):
+        # For CLIs (subl) that hand the files to an app we don't own and
+        # exit: the window that app opens is tracked instead of the process.
+        # Without wmctrl there is no way to find or close it
+        if owner is None or shutil.which("wmctrl") is None:
+            return self.spawn(argv)
+        window = Window()
+        self.track(owner, window)
+
+        def body():
+            with self.window_lock:
+                before = listWindows(window_class)
+                self.spawn(argv)
+                deadline = time.monotonic() + self.WINDOW_TIMEOUT
+                while True:
+                    opened = listWindows(window_class) - before
+                    if len(opened) > 0 or time.monotonic() > deadline:
+                        break
+                    time.sleep(self.WINDOW_POLL_INTERVAL)
+            window.adopt(sorted(opened))
+        threading.Thread(target=body, daemon=True).start()
+        return window
+
+    def track(self, owner, handle):
+        evicted = []
+        with self.lock:
+            self.reap()
+            if owner in self.workspaces:
+                self.workspaces.move_to_end(owner)
+            else:
+                self.workspaces[owner] = []
+                while self.max_workspaces is not None and len(self.workspaces) > self.max_workspaces:
+                    evicted.append(self.workspaces.popitem(last=False)[1])
+            self.workspaces[owner].append(handle)
+        for handles in evicted:
+            self.terminateInBackground(handles)
+
+    def reap(self):
+        self.untracked = [process for process in self.untracked if process.poll() is None]
+        for handles in self.workspaces.values():
+            for handle in handles:
+                if not isinstance(handle, Window):
+                    handle.poll()
+
+    def close(self, owner):
+        with self.lock:
+            handles = self.workspaces.pop(owner, [])
+        self.terminateInBackground(handles)
+
+    def closeAll(self):
+        with self.lock:
+            workspaces = list(self.workspaces.values())
+            self.workspaces.clear()
+        for handles in workspaces:
+            self.terminate(handles)
+
+    def openWorkspaces(self):
+        with self.lock:
+            return list(self.workspaces.keys())
+
+    def terminateInBackground(self, handles):
+        if len(handles) > 0:
+            threading.Thread(target=self.terminate, args=(handles,), daemon=True).start()
+
+    def terminate(self, handles):
+        for handle in handles:
+            if isinstance(handle, Window):
+                handle.close()
+        # Only children that are still running; an exited child's pid has
+        # been reaped (poll) and may belong to someone else by now
+        alive = [handle for handle in handles
+                 if not isinstance(handle, Window) and handle.poll() is None]
+        for process in alive:
+            process.terminate()
+        for process in alive:
+            try:
+                process.wait(self.TERMINATE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
@@ -0,0 +1,138 @@
+import fcntl
+import json
+import os
+
+import blobstore
+import shell_integration
+
+
+def manifestPath(fs_root):
+    # Kept beside the tree rather than in it, so writing the manifest never
+    # touches the directory mtimes it records
+    fs_root = os.path.normpath(fs_root)
+    return os.path.join(os.path.dirname(fs_root), ".%s.manifest.json" % os.path.basename(fs_root))
+
+
+LINK_INDEX_FILE = ".links.json"
+
+
+def loadLinkIndex(project_dir):
+    # link URL -> local URI, for every link of the project that finished
+    # downloading
+    try:
+        with open(os.path.join(project_dir, LINK_INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveLinkIndex(project_dir, index):
+    os.makedirs(project_dir, exist_ok=True)
+    path = os.path.join(project_dir, LINK_INDEX_FILE)
+    staging = path + ".%d" % os.getpid()
+    with open(staging, "w") as f:
+        json.dump(index, f)
+    os.replace(staging, path)
+
+
+def updateLinkIndex(project_dir, entries):
+    # Processes sharing a working dir finish different links of the same
+    # project, so the index is merged under a lock rather than overwritten.
+    # Links mapped to None are dropped
+    os.makedirs(project_dir, exist_ok=True)
+    with open(os.path.join(project_dir, LINK_INDEX_FILE + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = loadLinkIndex(project_dir)
+        for link, local_uri in entries.items():
+            if local_uri is None:
+                index.pop(link, None)
+            else:
+                index[link] = local_uri
+        saveLinkIndex(project_dir, index)
+    return index
+
+
+class Manifest(object):
+    VERSION = 1
+    # Larger files (datasets, mostly) are listed without a hash
+    HASH_SIZE_LIMIT = 256 << 20
+
+    def __init__(self, fs_root, directories, files, archives):
+        self.fs_root = fs_root
+        self.directories = directories
+        self.files = files
+        self.archives = archives
+
+    @classmethod
+    def build(cls, fs_root):
+        directories = {}
+        files = {}
+        archives = {}
+        for root, _, filenames in os.walk(fs_root):
+            relative_root = os.path.relpath(root, fs_root)
+            directories[relative_root] = os.stat(root).st_mtime_ns
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                relative_path = os.path.normpath(os.path.join(relative_root, filename))
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[relative_path] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "type": shell_integration.fileCategory(filename),
+                    "md5": blobstore.fileDigest(path) if stat.st_size <= cls.HASH_SIZE_LIMIT else None
+                }
+                if shell_integration.archiveExtension(filename) is not None:
+                    archives[relative_path] = {
+                        "extracted": os.path.isdir(shell_integration.extractDirFor(path))
+                    }
+        return cls(fs_root, directories, files, archives)
+
+    @classmethod
+    def load(cls, fs_root):
+        try:
+            with open(manifestPath(fs_root)) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if contents.get("version") != cls.VERSION:
+            return None
+        return cls(fs_root, contents["directories"], contents["files"], contents["archives"])
+
+    @classmethod
+    def current(cls, fs_root):
+        manifest = cls.load(fs_root)
+        if manifest is None or not manifest.valid():
+            manifest = cls.build(fs_root)
+            manifest.save()
+        return manifest
+
+    def save(self):
+        path = manifestPath(self.fs_root)
+        staging = path + ".%d" % os.getpid()
+        with open(staging, "w") as f:
+            json.dump({
+                "version": self.VERSION,
+                "directories": self.directories,
+                "files": self.files,
+                "archives": self.archives
+            }, f)
+        os.replace(staging, path)
+
+    def valid(self):
+        # Adding, removing or renaming anything bumps its directory's mtime,
+        # so one stat per directory stands in for a full walk
+        for relative_root, mtime in self.directories.items():
+            try:
+                if os.stat(os.path.join(self.fs_root, relative_root)).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def paths(self, file_type=None):
+        return [os.path.join(self.fs_root, relative_path)
+                for relative_path, entry in self.files.items()
+                if file_type is None or entry["type"] == file_type]
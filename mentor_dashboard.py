@@ -1,48 +1,123 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
+import html.parser
 import os
+import shutil
+import sys
 
-from bs4 import BeautifulSoup
 import dateutil.parser
 
+import download_lock
+import download_queue
 import gdrive
+import manifest
+import providers
 import shell_integration
-import threading
 
+# A table cell as the parser hands it over: its text and (text, href) links
+Cell = collections.namedtuple("Cell", ("text", "links"))
 
-def extractLinks(cell_node):
+LINK_WORKERS = 4
+# Shared by every project downloading at once, so the queue's workers don't
+# each bring LINK_WORKERS threads of their own
+link_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=LINK_WORKERS, thread_name_prefix="link")
+
+
+def extractLinks(cell):
     links = {}
-    link_nodes = cell_node.find_all("a")
-    for link_node in link_nodes:
-        links[link_node.get_text()] = link_node.get("href")
+    for link_text, href in cell.links:
+        links[link_text] = href
     return links
 
 
-def toDatetime(cell_node):
-    return dateutil.parser.parse(cell_node.get_text())
+def toDatetime(cell):
+    return dateutil.parser.parse(cell.text)
+
+
+def localNaive(date):
+    # Dates with and without a timezone can't be compared, so aware ones are
+    # brought to local time (what naive dates are taken to be in)
+    if date is None or date.tzinfo is None:
+        return date
+    return date.astimezone().replace(tzinfo=None)
+
+
+class DashboardParser(html.parser.HTMLParser):
+    # Turns dashboard HTML into rows of Cells as it is fed, without ever
+    # holding a document tree
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = collections.deque()
+        self.open_rows = []
+        self.cell_text = None
+        self.cell_links = None
+        self.link_href = None
+        self.link_text = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self.open_rows.append([])
+        elif tag == "td" and len(self.open_rows) > 0:
+            self.closeCell()
+            self.cell_text = []
+            self.cell_links = []
+        elif tag == "th":
+            # Header cells aren't columns; their text is skipped
+            self.closeCell()
+        elif tag == "a" and self.cell_text is not None:
+            self.link_href = dict(attrs).get("href")
+            self.link_text = []
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self.link_text is not None:
+            self.cell_links.append(("".join(self.link_text), self.link_href))
+            self.link_text = None
+        elif tag == "td":
+            self.closeCell()
+        elif tag == "tr" and len(self.open_rows) > 0:
+            self.closeCell()
+            self.rows.append(self.open_rows.pop())
+
+    def handle_data(self, data):
+        if self.cell_text is not None:
+            self.cell_text.append(data)
+        if self.link_text is not None:
+            self.link_text.append(data)
+
+    def closeCell(self):
+        if self.cell_text is not None and len(self.open_rows) > 0:
+            self.open_rows[-1].append(Cell("".join(self.cell_text).strip(), tuple(self.cell_links)))
+        self.cell_text = None
+        self.cell_links = None
+        self.link_text = None
 
 
 class ProjectFilter(object):
     def __init__(self):
         pass
 
+    def matches(self, project):
+        return True
+
     def filter(self, project_list):
-        return project_list
+        return [project for project in project_list if self.matches(project)]
 
 
 class RangedProjectFilter(ProjectFilter):
     def __init__(self, start_range, end_range):
-        self.start_range = start_range
-        self.end_range = end_range
+        self.start_range = localNaive(start_range)
+        self.end_range = localNaive(end_range)
 
-    def filter(self, project_list):
-        filtered_projects = []
-        for project in project_list:
-            if self.start_range is not None and project.date < self.start_range:
-                continue
-            if self.end_range is not None and project.date > self.end_range:
-                continue
-            filtered_projects.append(project)
-        return filtered_projects
+    def matches(self, project):
+        date = localNaive(project.date)
+        if self.start_range is not None and date < self.start_range:
+            return False
+        if self.end_range is not None and date > self.end_range:
+            return False
+        return True
 
 
 class RelativeProjectFilter(RangedProjectFilter):
@@ -58,6 +133,56 @@ class RelativeProjectFilter(RangedProjectFilter):
         )
 
 
+class UnitProjectFilter(ProjectFilter):
+    def __init__(self, units):
+        self.units = set(units)
+
+    def matches(self, project):
+        return project.unit in self.units
+
+
+class SearchProjectFilter(ProjectFilter):
+    def __init__(self, search_index, query):
+        self.query = query
+        self.matching_projects = search_index.matchingProjects(query)
+
+    def matches(self, project):
+        return os.path.basename(project.projectDir()) in self.matching_projects
+
+
+class OfflineError(Exception):
+    # Raised in offline mode for links that were never downloaded, along
+    # with the ones that were
+    def __init__(self, local_uris, missing_links):
+        super().__init__("Offline; not downloaded yet: %s" % ", ".join(missing_links))
+        self.local_uris = local_uris
+        self.missing_links = missing_links
+
+
+class Workspace(object):
+    # Everything projects from one dashboard load share: where they download
+    # to, how, and who hears about it
+    def __init__(self, download_clients, working_dir="/tmp",
+                 startCallback=None, progressCallback=None, completionCallback=None,
+                 daemon=None, download_queue=None, storage=None, search_index=None,
+                 reference_cache=None, offline=False):
+        self.working_dir = working_dir
+        self.download_clients = download_clients
+        self.startCallback = startCallback
+        self.progressCallback = progressCallback
+        self.completionCallback = completionCallback
+        self.daemon = daemon
+        self.download_queue = download_queue
+        self.storage = storage
+        self.search_index = search_index
+        self.reference_cache = reference_cache
+        self.offline = offline
+
+
+def sharedAttribute(name):
+    return property(lambda project: getattr(project.workspace, name))
+
+
 class Project(object):
 
     column_names = ["unit", "name", "date", "work", "rubric", "solution", "grade"]
@@ -68,84 +193,408 @@ class Project(object):
         "solution": extractLinks,
         "date": toDatetime,
     }
+    # Short strings repeated on most rows
+    interned_columns = ("unit", "grade")
 
-    def __init__(self, row_node, download_clients, working_dir="/tmp",
-                 startCallback=None, progressCallback=None, completionCallback=None):
-        self.working_dir = working_dir
-        self.download_clients = download_clients
-        cells = row_node.find_all("td", recursve=False)
+    # Dashboards run to tens of thousands of rows, so projects carry no
+    # per-instance __dict__ and reach shared state through their workspace
+    __slots__ = ("unit", "name", "date", "work", "rubric", "solution", "grade",
+                 "projectLinks", "workspace", "openContexts", "updated")
+    # Columns that can change without the project becoming a different one
+    mutable_columns = ("date", "rubric", "solution", "grade", "projectLinks")
+
+    working_dir = sharedAttribute("working_dir")
+    download_clients = sharedAttribute("download_clients")
+    startCallback = sharedAttribute("startCallback")
+    progressCallback = sharedAttribute("progressCallback")
+    completionCallback = sharedAttribute("completionCallback")
+    daemon = sharedAttribute("daemon")
+    storage = sharedAttribute("storage")
+    search_index = sharedAttribute("search_index")
+    reference_cache = sharedAttribute("reference_cache")
+    offline = sharedAttribute("offline")
+
+    def __init__(self, cells, workspace, link_tables=None):
+        self.workspace = workspace
+        self.openContexts = None
+        self.updated = False
         if len(cells) != len(Project.column_names):
             raise Exception()
         for idx, cell in enumerate(cells):
             col_name = Project.column_names[idx]
             if col_name in Project.column_parsers:
                 col_value = Project.column_parsers[col_name](cell)
+                if link_tables is not None and type(col_value) is dict:
+                    # Every project in a unit links the same rubric and
+                    # solution, so identical tables share one dict
+                    col_value = link_tables.setdefault(tuple(col_value.items()), col_value)
             else:
-                col_value = cell.get_text().strip()
+                col_value = cell.text
+            if col_name in Project.interned_columns:
+                col_value = sys.intern(col_value)
             setattr(self, col_name, col_value)
         self.projectLinks = self.name
         self.name = " ".join(self.projectLinks.keys())
-        self.openContexts = []
-        self.startCallback = startCallback
-        self.progressCallback = progressCallback
-        self.completionCallback = completionCallback
 
-    def getLocalURIs(self):
-        local_uris = {}
-        project_dir = os.path.join(self.working_dir, "%s %s" % (
+    @classmethod
+    def fromRecord(cls, record, workspace, link_tables=None):
+        project = cls.__new__(cls)
+        project.workspace = workspace
+        project.openContexts = None
+        project.updated = False
+        project.unit = sys.intern(record["unit"])
+        project.projectLinks = record["name"]
+        project.name = " ".join(project.projectLinks.keys())
+        project.date = datetime.datetime.fromisoformat(record["date"])
+        for col_name in ("work", "rubric", "solution"):
+            col_value = record[col_name]
+            if link_tables is not None:
+                col_value = link_tables.setdefault(tuple(col_value.items()), col_value)
+            setattr(project, col_name, col_value)
+        project.grade = sys.intern(record["grade"])
+        return project
+
+    def record(self):
+        # Everything fromRecord needs, so browsers attached to the daemon
+        # don't parse the dashboard again
+        return {
+            "unit": self.unit,
+            "name": self.projectLinks,
+            "date": self.date.isoformat(),
+            "work": self.work,
+            "rubric": self.rubric,
+            "solution": self.solution,
+            "grade": self.grade,
+        }
+
+    def key(self):
+        return (self.unit, self.name, tuple(self.work.items()))
+
+    def update(self, other):
+        for col_name in Project.mutable_columns:
+            value = getattr(other, col_name)
+            if getattr(self, col_name) != value:
+                setattr(self, col_name, value)
+                self.updated = True
+        return self.updated
+
+    def getLocalURIs(self, cancel_event=None):
+        if self.daemon is not None:
+            # The daemon owns the initialized clients and the download queue
+            if self.startCallback is not None:
+                self.startCallback("daemon")
+            try:
+                return self.daemon.fetch(unit=self.unit, name=self.name)
+            finally:
+                if self.completionCallback is not None:
+                    self.completionCallback()
+        project_dir = self.projectDir()
+        if self.storage is None:
+            return self.resolveLocalURIs(project_dir, cancel_event)
+        # Cold projects are restored from their archive before the links are
+        # checked, and can't be compressed again while in use
+        self.storage.acquire(project_dir)
+        try:
+            return self.resolveLocalURIs(project_dir, cancel_event)
+        finally:
+            self.storage.release(project_dir)
+
+    def projectDir(self):
+        return os.path.join(self.working_dir, "%s %s" % (
             self.unit, shell_integration.sanitizeFilesystemName(self.name)))
+
+    def scanLocalURIs(self, project_dir):
+        # Finished links are recorded in one index, so a downloaded project
+        # resolves with a single read and a stat per link instead of a walk.
+        # Returns the links on disk, the missing ones, and the index changes
+        # that would bring it in line with the disk
+        local_uris = {}
+        missing_links = {}
+        index_changes = {}
+        link_index = manifest.loadLinkIndex(project_dir)
         for link_name, link in self.work.items():
+            local_uri = link_index.get(link)
+            if local_uri is not None and os.path.exists(local_uri):
+                local_uris[link_name] = local_uri
+                continue
             link_dir = os.path.join(project_dir, shell_integration.sanitizeFilesystemName(link_name))
-            if os.path.exists(link_dir):
-                local_uris[link_name] = link_dir
-            else:
-                download_client = None
-                for candidate_name, candidate_client in self.download_clients.items():
-                    if candidate_client.matchURL(link):
-                        download_client = candidate_client
-                        break
-                if download_client is None:
-                    # TODO: route error reporting through GUI
-                    raise Exception("Unknown file provider for URL: %s" % link)
-                if self.startCallback is not None:
-                    self.startCallback(candidate_name)
-                result = download_client.downloadURL(
-                    link, cwd=self.working_dir, dirname=link_dir,
-                    progressCallback=self.progressCallback)
-                if self.completionCallback is not None:
-                    self.completionCallback()
-                if result is not None:
-                    shell_integration.expandArchives(result["local_uri"])
-                    local_uris[link_name] = result["local_uri"]
+            if (local_uri is None and os.path.exists(link_dir) and
+                    not download_lock.DownloadLock(self.working_dir, link_dir).inProgress()):
+                local_uri = self.localURI(link, link_dir)
+                if os.path.exists(local_uri):
+                    # Downloaded before the index existed
+                    local_uris[link_name] = index_changes[link] = local_uri
+                    continue
+            if link in link_index:
+                # Deleted or rolled back since it was recorded; downloaded
+                # again from scratch
+                index_changes[link] = None
+            missing_links[link_name] = (link, link_dir)
+        return local_uris, missing_links, index_changes
+
+    def resolveLocalURIs(self, project_dir, cancel_event=None):
+        local_uris, missing_links, index_changes = self.scanLocalURIs(project_dir)
+        if len(index_changes) > 0:
+            manifest.updateLinkIndex(project_dir, index_changes)
+        if len(missing_links) == 0 or self.offline:
+            if len(missing_links) > 0:
+                raise OfflineError(local_uris, list(missing_links.keys()))
+            return local_uris
+
+        # Submissions that link several docs export them side by side rather
+        # than one after another
+        jobs = {link_name: link_executor.submit(self.downloadLink, link, link_dir, cancel_event)
+                for link_name, (link, link_dir) in missing_links.items()}
+        concurrent.futures.wait(jobs.values())
+        for link_name, job in jobs.items():
+            result = job.result()
+            if result is not None:
+                local_uris[link_name] = result["local_uri"]
+        if self.search_index is not None:
+            try:
+                self.search_index.updateProject(project_dir)
+            except Exception:
+                # Searches just miss this project until it is indexed again
+                pass
         return local_uris
 
+    def localStatus(self):
+        # "downloaded", "partial", "downloading", "cold" (compressed by the
+        # storage manager) or "missing", and the links that are on disk
+        project_dir = self.projectDir()
+        if (self.storage is not None and not os.path.exists(project_dir) and
+                os.path.exists(self.storage.archivePath(project_dir))):
+            return "cold", {}
+        local_paths, missing_links, _ = self.scanLocalURIs(project_dir)
+        if len(missing_links) == 0:
+            return "downloaded", local_paths
+        for link, link_dir in missing_links.values():
+            if download_lock.DownloadLock(self.working_dir, link_dir).held():
+                return "downloading", local_paths
+        return ("partial" if len(local_paths) > 0 else "missing"), local_paths
+
+    def getReferenceURI(self, link):
+        # Rubric and solution links come from the unit-wide cache; None means
+        # the link has to be opened in the browser
+        if self.reference_cache is None:
+            return None
+        if self.offline:
+            return self.reference_cache.cached(link)
+        try:
+            _, download_client = self.findClient(link)
+        except Exception:
+            return None
+        if not hasattr(download_client, "revision"):
+            return None
+        return self.reference_cache.fetch(link, download_client)
+
+    def findClient(self, link):
+        candidate = providers.findProvider(self.download_clients, link)
+        if candidate is None:
+            # TODO: route error reporting through GUI
+            raise Exception("Unknown file provider for URL: %s" % link)
+        return candidate
+
+    def localURI(self, link, link_dir):
+        # Links into part of a download (a monorepo subfolder) resolve to
+        # that part rather than the link's whole directory
+        try:
+            _, download_client = self.findClient(link)
+        except Exception:
+            return link_dir
+        if hasattr(download_client, "localURI"):
+            return download_client.localURI(link, link_dir)
+        return link_dir
+
+    def downloadLink(self, link, link_dir, cancel_event=None):
+        candidate_name, download_client = self.findClient(link)
+        project_dir = os.path.dirname(link_dir)
+        # Other processes sharing the working dir (a second browser, the
+        # daemon) download into the same link_dir, so one downloads while the
+        # rest wait on it and follow its progress
+        lock = download_lock.DownloadLock(self.working_dir, link_dir)
+
+        def progress(metadata, fraction):
+            lock.progress(fraction)
+            if self.progressCallback is not None:
+                self.progressCallback(metadata, fraction)
+
+        def waiting(state):
+            if self.progressCallback is not None:
+                self.progressCallback(state, state.get("progress", 0.0))
+
+        if self.startCallback is not None:
+            self.startCallback(candidate_name)
+        try:
+            with lock.acquire(waiting, cancel_event):
+                finished = manifest.loadLinkIndex(project_dir).get(link)
+                if finished is not None and os.path.exists(finished):
+                    # Whoever held the lock downloaded it for us
+                    return {"local_uri": finished}
+                if lock.recovered:
+                    # Left half-written by a process that died mid-download
+                    shutil.rmtree(link_dir, ignore_errors=True)
+                try:
+                    # Once a provider stops answering, its other links fail
+                    # straight away instead of each waiting out a timeout
+                    breaker = None
+                    if hasattr(download_client, "breakerFor"):
+                        breaker = download_client.breakerFor(link)
+                    download = functools.partial(
+                        download_client.downloadURL, link, cwd=self.working_dir, dirname=link_dir,
+                        progressCallback=progress, cancel_event=cancel_event)
+                    result = download() if breaker is None else breaker.call(download)
+                    if result is not None:
+                        # Archives already unpacked as they arrived are
+                        # skipped, archives inside them are not
+                        shell_integration.expandArchives(result["local_uri"])
+                        # Later opens read this instead of walking the tree again
+                        manifest.Manifest.build(result["local_uri"]).save()
+                        # Recorded before the lock is released, so waiters
+                        # find it as soon as they get the lock
+                        manifest.updateLinkIndex(project_dir, {link: result["local_uri"]})
+                except Exception:
+                    # Failed and cancelled downloads leave nothing half-written
+                    shutil.rmtree(link_dir, ignore_errors=True)
+                    raise
+        finally:
+            if self.completionCallback is not None:
+                self.completionCallback()
+        return result
+
+    def fetchLocalURIs(self, completionCallback=None, failureCallback=None):
+        # Downloads run on the shared queue, so asking for a project that is
+        # already downloading joins the in-flight job
+        if self.workspace.download_queue is None:
+            self.workspace.download_queue = download_queue.DownloadQueue(1)
+        queue = self.workspace.download_queue
+        future = queue.submit(self)
+
+        def done(future):
+            try:
+                local_uris = future.result()
+            except (concurrent.futures.CancelledError, download_queue.DownloadCancelled):
+                # Whoever cancelled it has moved on
+                return
+            except OfflineError as e:
+                # Open what is on disk and say what isn't
+                if len(e.local_uris) > 0 and completionCallback is not None:
+                    completionCallback(e.local_uris)
+                if failureCallback is not None:
+                    failureCallback(e)
+                return
+            except Exception as e:
+                if failureCallback is not None:
+                    failureCallback(e)
+                return
+            if completionCallback is not None:
+                completionCallback(local_uris)
+        queue.then(future, done)
+        return future
+
     def close(self):
-        for context in self.openContexts:
-            context()
-        self.openContexts.clear()
+        if self.openContexts is not None:
+            for context in self.openContexts:
+                context()
+            self.openContexts = None
+        # Bandwidth goes to whatever is opened next, including downloads
+        # started without opening the project
+        if self.workspace.download_queue is not None:
+            self.workspace.download_queue.cancel(self)
 
-    def open(self, openCompletionCallback=None):
-        def body():
-            local_uris = self.getLocalURIs()
+    def open(self, openCompletionCallback=None, openFailureCallback=None):
+        def body(local_uris):
+            uri = None
+            if self.openContexts is None:
+                # Closed while downloading
+                return
+            if self.storage is not None:
+                # Editors and shells work in the project dir until it is
+                # closed, so it can't be compressed from under them
+                self.openContexts.append(self.storage.pin(self.projectDir()))
             for uri in local_uris.values():
-                self.openContexts.extend(shell_integration.openAllFiles(uri))
+                self.openContexts.extend(shell_integration.openAllFiles(uri, owner=self.key()))
             # TODO figure out how to handle multiple uris here rather than
             #   just opening the last one:
-            if os.path.isdir(uri):
+            if uri is not None and os.path.isdir(uri):
                 shell_integration.syncShells(uri)
             if openCompletionCallback is not None:
                 openCompletionCallback()
-        threading.Thread(target=body).start()
+        if self.openContexts is None:
+            self.openContexts = []
+        self.fetchLocalURIs(body, openFailureCallback)
 
 
-def getProjectsFromHTML(html, *args, **kwargs):
-    projects = []
-    parsed_result = BeautifulSoup(html, 'html.parser')
-    rows = parsed_result.find_all("tr")
-    for row in rows:
+def prefetchMetadata(projects, download_clients):
+    # Resolve every link the dashboard mentions in as few requests as the
+    # providers allow, ahead of the first download
+    links = []
+    for project in projects:
+        for link_table in (project.work, project.rubric, project.solution):
+            links.extend(link_table.values())
+    prefetched = 0
+    for client in download_clients.values():
+        if not hasattr(client, "prefetchMetadata"):
+            continue
+        # Runs off the UI thread, so it can wait out (or do) the client's
+        # startup instead of skipping it; it never prompts for authorization
+        if not client.initialized() and not client.initialize(attemptAuthorization=False):
+            continue
+        prefetched += client.prefetchMetadata([link for link in links if client.matchURL(link)])
+    return prefetched
+
+
+def mergeProjects(old_projects, new_projects):
+    # Projects that survive a reload keep their original object, along with
+    # any download or open editors attached to it
+    survivors = {}
+    for project in old_projects:
+        survivors.setdefault(project.key(), []).append(project)
+    merged = []
+    for project in new_projects:
+        candidates = survivors.get(project.key())
+        if candidates:
+            survivor = candidates.pop(0)
+            survivor.update(project)
+            merged.append(survivor)
+        else:
+            merged.append(project)
+    return merged
+
+
+def iterDashboardRows(source, chunk_size=1 << 16):
+    # source is either the HTML itself or a file object to read it from
+    parser = DashboardParser()
+    if isinstance(source, str):
+        chunks = (source[idx:idx + chunk_size] for idx in range(0, len(source), chunk_size))
+    else:
+        chunks = iter(lambda: source.read(chunk_size), "")
+    for chunk in chunks:
+        parser.feed(chunk)
+        while len(parser.rows) > 0:
+            yield parser.rows.popleft()
+    parser.close()
+    while len(parser.rows) > 0:
+        yield parser.rows.popleft()
+
+
+def iterProjectsFromHTML(source, *args, share_links=True, **kwargs):
+    # Sharing identical link tables saves memory when every project is kept,
+    # but grows with the dashboard when projects are streamed and dropped
+    workspace = Workspace(*args, **kwargs)
+    link_tables = {} if share_links else None
+    for cells in iterDashboardRows(source):
         try:
-            project = Project(row, *args, **kwargs)
-            projects.append(project)
+            yield Project(cells, workspace, link_tables)
         except Exception:
             pass
-    return projects
+
+
+def getProjectsFromHTML(html, *args, **kwargs):
+    return list(iterProjectsFromHTML(html, *args, **kwargs))
+
+
+def getProjectsFromRecords(records, *args, **kwargs):
+    workspace = Workspace(*args, **kwargs)
+    link_tables = {}
+    return [Project.fromRecord(record, workspace, link_tables) for record in records]
@@ -0,0 +1,61 @@
+import urllib.parse
+
+
+def urlHost(url):
+    # Dashboard links often leave the scheme off
+    if "://" not in url:
+        url = "http://" + url
+    try:
+        return (urllib.parse.urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class ProviderRegistry(dict):
+    # name -> client, like the plain dict it replaces, plus an index from
+    # host to the clients serving it so a link's client is found with a
+    # lookup per domain level instead of every client's regex.
+    #
+    # Clients list their domains in HOSTS ("google.com" also covers
+    # "docs.google.com"); clients without HOSTS are fallbacks, tried in
+    # registration order after the indexed ones
+    def __init__(self, clients=()):
+        super().__init__()
+        self.hosts = {}
+        self.fallbacks = []
+        for name, client in clients:
+            self.register(name, client)
+
+    def register(self, name, client):
+        self[name] = client
+        hosts = getattr(client, "HOSTS", None)
+        if hosts is None:
+            self.fallbacks.append(name)
+        else:
+            for host in hosts:
+                self.hosts.setdefault(host, []).append(name)
+        return client
+
+    def candidates(self, url):
+        labels = urlHost(url).split(".")
+        for idx in range(len(labels)):
+            for name in self.hosts.get(".".join(labels[idx:]), []):
+                yield name
+        for name in self.fallbacks:
+            yield name
+
+    def find(self, url):
+        for name in self.candidates(url):
+            client = self.get(name)
+            if client is not None and client.matchURL(url):
+                return name, client
+        return None
+
+
+def findProvider(download_clients, url):
+    if isinstance(download_clients, ProviderRegistry):
+        return download_clients.find(url)
+    for name, client in download_clients.items():
+        if client.matchURL(url):
+            return name, client
+    return None
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class ReferenceCache(object):
+    # Rubrics and solutions are shared by every project in a unit, so they
+    # are downloaded once per URL instead of once per project
+    CACHE_DIR = ".reference"
+    INDEX_FILE = "index.json"
+    # Opening a unit's submissions one after another only asks the provider
+    # whether the document changed this often
+    REVALIDATE_SECONDS = 5 * 60
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.root = os.path.join(working_dir, self.CACHE_DIR)
+        self.index_file = os.path.join(self.root, self.INDEX_FILE)
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.index = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    self.index = json.load(f)
+            except ValueError:
+                pass
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        staging = self.index_file + ".%d" % os.getpid()
+        with open(staging, "w") as f:
+            json.dump(self.index, f)
+        os.replace(staging, self.index_file)
+
+    def entryDir(self, url):
+        return os.path.join(self.root, hashlib.md5(url.encode()).hexdigest())
+
+    def urlLock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def cached(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+        if entry is None or not os.path.exists(entry["local_uri"]):
+            return None
+        return entry["local_uri"]
+
+    def fetch(self, url, download_client, progressCallback=None):
+        # Projects opened together wait for one download of their rubric
+        with self.urlLock(url):
+            with self.lock:
+                entry = self.index.get(url)
+            if entry is not None and os.path.exists(entry["local_uri"]):
+                if time.time() - entry["checked"] < self.REVALIDATE_SECONDS:
+                    return entry["local_uri"]
+                try:
+                    revision = download_client.revision(url)
+                except Exception:
+                    # Can't tell whether it changed; the copy we have will do
+                    return entry["local_uri"]
+                # No revision (the branch can't be resolved) says nothing
+                # about whether it changed either
+                if revision is None or revision == entry["revision"]:
+                    with self.lock:
+                        entry["checked"] = time.time()
+                        self.save()
+                    return entry["local_uri"]
+            else:
+                revision = download_client.revision(url)
+            return self.download(url, download_client, revision, progressCallback)
+
+    def download(self, url, download_client, revision, progressCallback=None):
+        entry_dir = self.entryDir(url)
+        staging_dir = entry_dir + ".part"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            result = download_client.downloadURL(
+                url, cwd=self.working_dir, dirname=staging_dir, progressCallback=progressCallback)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        # A single document opens as itself rather than as its folder
+        local_uri = result["local_uri"]
+        if len(result.get("files", [])) == 1 and len(result.get("dirs", {})) == 0:
+            local_uri = result["files"][0].get("local_uri", local_uri)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+        local_uri = os.path.join(entry_dir, os.path.relpath(local_uri, staging_dir))
+        with self.lock:
+            self.index[url] = {"local_uri": local_uri, "revision": revision, "checked": time.time()}
+            self.save()
+        return local_uri
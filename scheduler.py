@@ -0,0 +1,138 @@
+import collections
+import random
+import threading
+import time
+
+
+class RequestScheduler(object):
+    # Drive's default per-user quota works out to roughly this many requests
+    # a second
+    DEFAULT_RATE = 10.0
+    DEFAULT_BURST = 20
+    DEFAULT_MAX_CONCURRENCY = 8
+    MAX_RETRIES = 6
+    BASE_DELAY = 1.0
+    MAX_DELAY = 64.0
+    # Window the effective request rate is measured over
+    RATE_WINDOW = 60.0
+
+    THROTTLED = "throttled"
+    TRANSIENT = "transient"
+
+    def __init__(self, classify, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        # classify(exception) -> THROTTLED, TRANSIENT, or None if the
+        # request should fail straight away
+        self.classify = classify
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.condition = threading.Condition()
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.started = self.last_refill
+        # AIMD: grow the concurrency limit by one per limit's worth of
+        # successes, halve it whenever Drive pushes back
+        self.concurrency_limit = float(max_concurrency)
+        self.active = 0
+        self.completed = collections.deque()
+        self.metrics = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                self.refill()
+                if self.active < int(self.concurrency_limit) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+                if self.active < int(self.concurrency_limit):
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    timeout = None
+                self.condition.wait(timeout)
+
+    def release(self, outcome):
+        with self.condition:
+            self.active -= 1
+            if outcome is None:
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1.0 / self.concurrency_limit)
+                self.completed.append(time.monotonic())
+            elif outcome == self.THROTTLED:
+                self.throttle()
+            self.condition.notify_all()
+
+    def throttle(self):
+        self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+        # Drain the bucket too, so the next requests space out
+        self.tokens = min(self.tokens, 0)
+
+    def recordFailure(self, outcome, retrying):
+        # For the requests inside a batch, which fail on their own while the
+        # batch itself goes through call() successfully
+        with self.condition:
+            self.metrics["requests"] += 1
+            if outcome == self.THROTTLED:
+                self.metrics["throttled"] += 1
+                self.throttle()
+            self.metrics["retries" if retrying else "failed"] += 1
+            self.condition.notify_all()
+
+    def backoff(self, attempt):
+        # Full jitter keeps parallel downloads from retrying in lockstep
+        return random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * (2 ** attempt)))
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                outcome = self.classify(e)
+                self.release(outcome if outcome is not None else self.TRANSIENT)
+                with self.condition:
+                    self.metrics["requests"] += 1
+                    if outcome == self.THROTTLED:
+                        self.metrics["throttled"] += 1
+                    if outcome is None or attempt >= self.MAX_RETRIES:
+                        self.metrics["failed"] += 1
+                        raise
+                    self.metrics["retries"] += 1
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.release(None)
+            with self.condition:
+                self.metrics["requests"] += 1
+            return result
+
+    def execute(self, request):
+        return self.call(request.execute)
+
+    def effectiveRate(self):
+        with self.condition:
+            now = time.monotonic()
+            while len(self.completed) > 0 and self.completed[0] < now - self.RATE_WINDOW:
+                self.completed.popleft()
+            return len(self.completed) / max(1.0, min(self.RATE_WINDOW, now - self.started))
+
+    def snapshot(self):
+        rate = self.effectiveRate()
+        with self.condition:
+            snapshot = dict(self.metrics)
+            snapshot["concurrency_limit"] = int(self.concurrency_limit)
+        snapshot["requests_per_second"] = round(rate, 2)
+        return snapshot
+
+    def summary(self):
+        snapshot = self.snapshot()
+        return ("%(requests)d requests, %(retries)d retries, %(throttled)d throttled, "
+                "%(failed)d failed, %(requests_per_second).2f req/s, "
+                "concurrency %(concurrency_limit)d" % snapshot)
@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+import threading
+
+import shell_integration
+
+
+class SearchIndex(object):
+    INDEX_FILE = ".search.sqlite3"
+    # Bigger text files are generated output or data, not code anyone
+    # searches for
+    MAX_FILE_SIZE = 2 << 20
+    NOTEBOOK_EXTENSION = ".ipynb"
+    # The trigram tokenizer can't match anything shorter
+    MIN_QUERY_LENGTH = 3
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.index_file = os.path.join(working_dir, self.INDEX_FILE)
+        self.lock = threading.Lock()
+        self.thread_state = threading.local()
+        # False where sqlite is older than 3.34 and has no trigram tokenizer;
+        # searches then scan the stored text with LIKE instead
+        self.full_text = True
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self.thread_state, "connection", None)
+        if connection is None:
+            os.makedirs(self.working_dir, exist_ok=True)
+            connection = sqlite3.connect(self.index_file, timeout=30)
+            # Readers (the browser, --search) don't wait on a daemon that is
+            # indexing
+            connection.execute("PRAGMA journal_mode=WAL")
+            # A document's text is stored under its documents.id, so updates
+            # never have to scan the full-text table
+            connection.execute("CREATE TABLE IF NOT EXISTS documents ("
+                               "id INTEGER PRIMARY KEY, path TEXT UNIQUE, project TEXT, "
+                               "size INTEGER, mtime INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS documents_project ON documents (project)")
+            try:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS contents USING fts5("
+                                   "body, tokenize='trigram')")
+            except sqlite3.OperationalError:
+                self.full_text = False
+                connection.execute("CREATE TABLE IF NOT EXISTS contents (body TEXT)")
+            self.thread_state.connection = connection
+        return connection
+
+    @classmethod
+    def indexable(cls, filename):
+        return (filename.endswith(cls.NOTEBOOK_EXTENSION) or
+                shell_integration.fileCategory(filename) == "plaintext")
+
+    @classmethod
+    def readText(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if b"\0" in data[:8192]:
+            return None
+        text = data.decode("utf-8", errors="replace")
+        if path.endswith(cls.NOTEBOOK_EXTENSION):
+            # Index what was written in the cells, not the JSON and the
+            # base64 plots around it
+            try:
+                cells = json.loads(text).get("cells", [])
+            except (ValueError, AttributeError):
+                return text
+            text = "\n".join("".join(cell.get("source", [])) for cell in cells)
+        return text
+
+    def updateProject(self, project_dir):
+        project = os.path.basename(os.path.normpath(project_dir))
+        found = {}
+        for root, dirs, files in os.walk(project_dir):
+            # Manifests, link indexes and .git
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for filename in files:
+                if filename.startswith(".") or not self.indexable(filename):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size <= self.MAX_FILE_SIZE:
+                    found[os.path.relpath(path, self.working_dir)] = (stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            connection = self.connection
+            known = {path: (document_id, (size, mtime)) for document_id, path, size, mtime in
+                     connection.execute("SELECT id, path, size, mtime FROM documents "
+                                        "WHERE project = ?", (project,))}
+            stale = [path for path in known if known[path][1] != found.get(path)]
+            fresh = [path for path in found if path not in known or known[path][1] != found[path]]
+            with connection:
+                for path in stale:
+                    document_id = known[path][0]
+                    connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+                    connection.execute("DELETE FROM contents WHERE rowid = ?", (document_id,))
+                for path in fresh:
+                    try:
+                        text = self.readText(os.path.join(self.working_dir, path))
+                    except OSError:
+                        continue
+                    size, mtime = found[path]
+                    # Binary files are recorded too, so they aren't read again
+                    document_id = connection.execute(
+                        "INSERT INTO documents (path, project, size, mtime) VALUES (?, ?, ?, ?)",
+                        (path, project, size, mtime)).lastrowid
+                    if text is not None:
+                        connection.execute("INSERT INTO contents (rowid, body) VALUES (?, ?)",
+                                           (document_id, text))
+        return len(fresh), len(stale)
+
+    def updateAll(self):
+        updated = 0
+        for name in sorted(os.listdir(self.working_dir)) if os.path.isdir(self.working_dir) else []:
+            project_dir = os.path.join(self.working_dir, name)
+            if not name.startswith(".") and os.path.isdir(project_dir):
+                updated += self.updateProject(project_dir)[0]
+        # Projects deleted from disk since they were indexed
+        with self.lock:
+            indexed = [row[0] for row in self.connection.execute("SELECT DISTINCT project FROM documents")]
+        for project in indexed:
+            if not os.path.isdir(os.path.join(self.working_dir, project)):
+                self.removeProject(project)
+        return updated
+
+    def removeProject(self, project_dir):
+        project = os.path.basename(os.path.normpath(project_dir))
+        with self.lock, self.connection as connection:
+            connection.execute("DELETE FROM contents WHERE rowid IN "
+                               "(SELECT id FROM documents WHERE project = ?)", (project,))
+            connection.execute("DELETE FROM documents WHERE project = ?", (project,))
+
+    def matchExpression(self, query):
+        if len(query) < self.MIN_QUERY_LENGTH:
+            raise ValueError("Search for at least %d characters" % self.MIN_QUERY_LENGTH)
+        # One quoted phrase, so punctuation in code ("import pandas as pd",
+        # "df.groupby(") is matched literally
+        return '"%s"' % query.replace('"', '""')
+
+    def matchCondition(self, query):
+        # Opening the connection is what finds out whether fts5 works
+        self.connection
+        if self.full_text:
+            return "contents MATCH ?", self.matchExpression(query)
+        if len(query) < self.MIN_QUERY_LENGTH:
+            raise ValueError("Search for at least %d characters" % self.MIN_QUERY_LENGTH)
+        pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return "contents.body LIKE ? ESCAPE '\\'", "%" + pattern + "%"
+
+    def search(self, query, limit=None):
+        condition, parameter = self.matchCondition(query)
+        statement = ("SELECT documents.project, documents.path FROM contents "
+                     "JOIN documents ON documents.id = contents.rowid "
+                     "WHERE %s ORDER BY documents.project, documents.path" % condition)
+        if limit is not None:
+            statement += " LIMIT %d" % limit
+        return self.connection.execute(statement, (parameter,)).fetchall()
+
+    def matchingProjects(self, query):
+        condition, parameter = self.matchCondition(query)
+        return set(row[0] for row in self.connection.execute(
+            "SELECT DISTINCT documents.project FROM contents "
+            "JOIN documents ON documents.id = contents.rowid WHERE %s" % condition,
+            (parameter,)))
@@ -1,34 +1,58 @@
 import klembord
 import os
 import shutil
-import subprocess
 import mimetypes
+import re
+import tarfile
+import tempfile
+import threading
+
+import launcher
+import manifest
+
+SHELL_CHANNEL_ROOT = os.path.join(tempfile.gettempdir(), "springboard-%d" % os.getuid())
+# tourguide.sh builds the same channel path from the raw name, so names are
+# checked against this rather than sanitized
+SHELL_SESSION_PARSER = re.compile(r"^[A-Za-z0-9_-]+$")
+DEFAULT_SHELL_SESSION = os.environ.get("SPRINGBOARD_SESSION", "default")
+active_shell_session = DEFAULT_SHELL_SESSION
+active_launcher = launcher.Launcher()
 
 
 class SublimeIDE(object):
+    # The subl CLI hands the files to the running Sublime (starting it if
+    # needed), which we don't own: killing it would take the user's other
+    # windows along. So each project gets a new window, which is what
+    # closing the project closes
+    WINDOW_CLASS = "sublime_text"
+
     @staticmethod
-    def open(fs_root, files):
-        subprocess.run(["subl", "-n", fs_root] + files,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return SublimeIDE.close
+    def open(fs_root, files, owner=None):
+        active_launcher.spawnWindow(["subl", "-n", fs_root] + files, owner, SublimeIDE.WINDOW_CLASS)
+        return lambda: SublimeIDE.close(owner)
 
     @staticmethod
-    def close():
-        # TODO
-        pass
+    def close(owner=None):
+        if owner is not None:
+            active_launcher.close(owner)
 
 
 class GnomeGeneric(object):
+    # Closing only reaches a viewer that xdg-open runs in the foreground; one
+    # it forks or hands off to an already running app stays open
     @staticmethod
-    def open(fs_root, files):
-        subprocess.run(["xdg-open"] + files,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return GnomeGeneric.close
+    def open(fs_root, files, owner=None):
+        active_launcher.spawn(["xdg-open"] + files, owner)
+        return lambda: GnomeGeneric.close(owner)
 
     @staticmethod
-    def close():
-        # TODO
-        pass
+    def close(owner=None):
+        if owner is not None:
+            active_launcher.close(owner)
+
+
+def setMaxWorkspaces(max_workspaces):
+    active_launcher.max_workspaces = max_workspaces
 
 
 def sanitizeFilesystemName(string):
@@ -50,48 +74,115 @@ Icon=text-html
     return full_dir
 
 
+def archiveExtension(filename):
+    # Longest match, so that "x.tar.gz" is a gzipped tar rather than a ".gz"
+    matches = [ext for _, file_types, _ in shutil.get_unpack_formats()
+               for ext in file_types if filename.lower().endswith(ext)]
+    if len(matches) == 0:
+        return None
+    return max(matches, key=len)
+
+
+def isStreamableArchive(filename):
+    extension = archiveExtension(filename)
+    return extension is not None and extension != ".zip"
+
+
+def extractDirFor(archive_file):
+    return archive_file[:-len(archiveExtension(archive_file))] + ".extracted"
+
+
+def extractArchive(archive_file):
+    extract_dir = extractDirFor(archive_file)
+    os.makedirs(extract_dir, exist_ok=True)
+    shutil.unpack_archive(archive_file, extract_dir=extract_dir)
+    return extract_dir
+
+
+class StreamingExtractor(object):
+    # A write-only file object; tar data written to it is unpacked on a
+    # background thread while the rest is still arriving
+    DRAIN_CHUNK = 1 << 16
+
+    def __init__(self, extract_dir):
+        self.extract_dir = extract_dir
+        self.error = None
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, "rb")
+        self.writer = os.fdopen(write_fd, "wb")
+        os.makedirs(extract_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.extract, daemon=True)
+        self.thread.start()
+
+    def extract(self):
+        try:
+            with tarfile.open(fileobj=self.reader, mode="r|*") as archive:
+                if hasattr(tarfile, "data_filter"):
+                    archive.extractall(self.extract_dir, filter="data")
+                else:
+                    archive.extractall(self.extract_dir)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Keep consuming so the writer never blocks on a full pipe
+            while self.reader.read(self.DRAIN_CHUNK):
+                pass
+            self.reader.close()
+
+    def write(self, data):
+        self.writer.write(data)
+        return len(data)
+
+    def close(self, discard=False):
+        self.writer.close()
+        self.thread.join()
+        if discard or self.error is not None:
+            shutil.rmtree(self.extract_dir, ignore_errors=True)
+        if self.error is not None and not discard:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A failed transfer leaves a truncated stream; drop what was unpacked
+        # and let the transfer's own error propagate
+        self.close(discard=exc_type is not None)
+
+
 def expandArchives(fs_root):
-    archive_extensions = []
-    for _, file_types, _ in shutil.get_unpack_formats():
-        archive_extensions.extend(file_types)
     for root, dirs, files in os.walk(fs_root):
         for file in files:
-            name, ext = os.path.splitext(file)
-            if ext in archive_extensions:
-                archive_file = os.path.join(root, file)
-                extract_dir = os.path.join(root, name + ".extracted")
-                os.makedirs(extract_dir, exist_ok=True)
-                shutil.unpack_archive(archive_file, extract_dir=extract_dir)
-                dirs.append(extract_dir)
-
-
-def openAllFiles(fs_root):
+            archive_file = os.path.join(root, file)
+            if archiveExtension(file) is None or os.path.isdir(extractDirFor(archive_file)):
+                continue
+            dirs.append(extractArchive(archive_file))
+
+
+def fileCategory(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    if mimetype is None:
+        return None
+    major, minor = mimetype.split("/")
+    if major == "text" or minor in ("javascript", "json", "xml", "x-sql"):
+        return "plaintext"
+    elif mimetype == "application/pdf":
+        return "pdf"
+    return None
+
+
+def openAllFiles(fs_root, owner=None):
+    contents = manifest.Manifest.current(fs_root)
     file_lists = {
-        "plaintext": [],
-        "pdf": []
+        "plaintext": contents.paths("plaintext"),
+        "pdf": contents.paths("pdf")
     }
 
-    for root, _, files in os.walk(fs_root):
-        for filename in files:
-            try:
-                mimetype = mimetypes.guess_type(filename)[0]
-                major, minor = mimetype.split("/")
-                file_list = None
-                if major == "text" or minor in ("javascript", "json", "xml", "x-sql"):
-                    file_list = "plaintext"
-                elif mimetype == "application/pdf":
-                    file_list = "pdf"
-                if file_list is not None:
-                    full_path = os.path.join(root, filename)
-                    file_lists[file_list].append(full_path)
-            except Exception:
-                pass
-
     openContexts = []
     if len(file_lists["plaintext"]) > 0:
-        openContexts.append(SublimeIDE.open(fs_root, file_lists["plaintext"]))
+        openContexts.append(SublimeIDE.open(fs_root, file_lists["plaintext"], owner))
     if len(file_lists["pdf"]) > 0:
-        openContexts.append(GnomeGeneric.open(fs_root, file_lists["pdf"]))
+        openContexts.append(GnomeGeneric.open(fs_root, file_lists["pdf"], owner))
     return openContexts
 
 
@@ -101,9 +192,33 @@ def openLink(url):
     GnomeGeneric.open(None, [url])
 
 
-def syncShells(new_path):
-    with open("/tmp/springboard_active_directory", "w") as f:
+def parseShellSession(text):
+    if SHELL_SESSION_PARSER.match(text) is None:
+        raise ValueError("Invalid session name '%s'; use letters, digits, '-' and '_'" % text)
+    return text
+
+
+def setShellSession(session):
+    global active_shell_session
+    active_shell_session = parseShellSession(session)
+
+
+def shellChannel(session=None):
+    if session is None:
+        session = active_shell_session
+    return os.path.join(SHELL_CHANNEL_ROOT, parseShellSession(session), "directory")
+
+
+def syncShells(new_path, session=None):
+    # Shells attached with tourguide.sh read this file from their prompt hook
+    # and cd in place; replace it atomically so they never see a partial path
+    channel = shellChannel(session)
+    os.makedirs(os.path.dirname(channel), mode=0o700, exist_ok=True)
+    # Projects opened together sync from several threads at once
+    fd, staging = tempfile.mkstemp(dir=os.path.dirname(channel), prefix="directory.")
+    with os.fdopen(fd, "w") as f:
         f.write(new_path)
+    os.replace(staging, channel)
 
 
 def openFolder(uri):
@@ -0,0 +1,98 @@
+import collections
+import sys
+import threading
+import time
+import traceback
+
+
+class Stall(object):
+    def __init__(self, started, stack):
+        self.started = started
+        self.stack = stack
+        self.duration = None
+
+    def describe(self, max_frames=None):
+        stack = self.stack if max_frames is None else self.stack[-max_frames:]
+        return "%s: UI blocked for %.1fs in\n%s" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            self.duration, "".join(stack).rstrip())
+
+
+class StallDetector(object):
+    # How often the loop checks in, and how often the watcher looks
+    HEARTBEAT_INTERVAL = 0.1
+    DEFAULT_THRESHOLD = 1.0
+    KEPT_STALLS = 20
+
+    def __init__(self, loop, threshold=DEFAULT_THRESHOLD, log_file=None, stallCallback=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.log_file = log_file
+        self.stallCallback = stallCallback
+        self.lock = threading.Lock()
+        self.stalls = collections.deque(maxlen=self.KEPT_STALLS)
+        self.pending = None
+        self.last_beat = None
+        self.loop_thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        # Has to be called from the thread that will run the loop
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.loop.set_alarm_in(self.HEARTBEAT_INTERVAL, self.heartbeat)
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def heartbeat(self, loop, unused=None):
+        now = time.monotonic()
+        with self.lock:
+            stall = self.pending
+            self.pending = None
+            if stall is not None:
+                stall.duration = now - self.last_beat
+                self.stalls.append(stall)
+            self.last_beat = now
+        if stall is not None:
+            self.record(stall)
+        if not self.stopped.is_set():
+            loop.set_alarm_in(self.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def watch(self):
+        # The loop can't notice its own stall until it is over, so the stack
+        # is taken from here while it is still blocked
+        while not self.stopped.wait(self.HEARTBEAT_INTERVAL):
+            with self.lock:
+                if self.pending is not None or time.monotonic() - self.last_beat < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is None:
+                    continue
+                self.pending = Stall(time.time() - (time.monotonic() - self.last_beat),
+                                     traceback.format_stack(frame))
+
+    def record(self, stall):
+        if self.log_file is not None:
+            try:
+                with open(self.log_file, "a") as f:
+                    f.write(stall.describe() + "\n\n")
+            except OSError:
+                pass
+        if self.stallCallback is not None:
+            self.stallCallback(stall)
+
+    def report(self, max_frames=8):
+        with self.lock:
+            stalls = list(self.stalls)
+        if len(stalls) == 0:
+            return "No stalls over %.1fs recorded" % self.threshold
+        # The latest stall in full, the ones before it as one line each
+        lines = ["%d stalls over %.1fs, longest %.1fs" % (
+            len(stalls), self.threshold, max(stall.duration for stall in stalls))]
+        for stall in stalls[:-1]:
+            lines.append("  %.1fs at %s" % (stall.duration, stall.stack[-1].strip().split("\n")[0]))
+        lines.append("")
+        lines.append(stalls[-1].describe(max_frames))
+        return "\n".join(lines)
@@ -0,0 +1,303 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+SIZE_PARSER = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parseSize(text):
+    match = SIZE_PARSER.match(text)
+    if match is None:
+        raise ValueError("Invalid size '%s'" % text)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def treeSize(fs_root, seen_inodes=None):
+    # Hardlinked files (export cache, deduplicated blobs) only count once
+    if seen_inodes is None:
+        seen_inodes = set()
+    total = 0
+    for root, _, files in os.walk(fs_root):
+        for filename in files:
+            try:
+                stat = os.lstat(os.path.join(root, filename))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen_inodes:
+                continue
+            seen_inodes.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
+
+
+def reclaimableSize(fs_root, blob_inodes=()):
+    # What deleting fs_root frees: files with no links outside it, counting
+    # a link from the blob store as gone since garbage collection drops it
+    links = {}
+    for root, _, files in os.walk(fs_root):
+        for filename in files:
+            try:
+                stat = os.lstat(os.path.join(root, filename))
+            except OSError:
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            count, _ = links.get(key, (0, stat))
+            links[key] = (count + 1, stat)
+    total = 0
+    for key, (count, stat) in links.items():
+        if stat.st_nlink - (1 if key in blob_inodes else 0) <= count:
+            total += stat.st_size
+    return total
+
+
+class StorageManager(object):
+    STATE_FILE = ".storage.json"
+    COLD_DIR = ".cold"
+    PIN_DIR = ".locks"
+    ARCHIVE_FORMAT = "gztar"
+    ARCHIVE_EXTENSION = ".tar.gz"
+    # Projects opened more recently than this are never compressed
+    MIN_IDLE_SECONDS = 10 * 60
+
+    def __init__(self, working_dir, budget_bytes=None, blob_store=None, search_index=None):
+        self.working_dir = working_dir
+        self.budget_bytes = budget_bytes
+        self.blob_store = blob_store
+        self.search_index = search_index
+        self.cold_dir = os.path.join(working_dir, self.COLD_DIR)
+        self.state_file = os.path.join(working_dir, self.STATE_FILE)
+        self.lock = threading.RLock()
+        # Signalled whenever a project finishes being compressed or restored
+        self.changed = threading.Condition(self.lock)
+        self.in_use = {}
+        # Projects being compressed or restored outside the lock
+        self.busy = set()
+        self.enforcing = False
+        self.last_open = {}
+        # Archived project -> its files that were linked from the blob store
+        self.blob_links = {}
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file) as f:
+                    state = json.load(f)
+                self.last_open = state.get("last_open", {})
+                self.blob_links = state.get("blob_links", {})
+            except ValueError:
+                pass
+
+    def save(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        staging = self.state_file + ".%d" % os.getpid()
+        with open(staging, "w") as f:
+            json.dump({"last_open": self.last_open, "blob_links": self.blob_links}, f)
+        os.replace(staging, self.state_file)
+
+    def archivePath(self, project_dir):
+        return os.path.join(self.cold_dir, os.path.basename(project_dir) + self.ARCHIVE_EXTENSION)
+
+    def pinFile(self, project_dir):
+        name = hashlib.md5(os.path.basename(project_dir).encode()).hexdigest()
+        return os.path.join(self.working_dir, self.PIN_DIR, name + ".open")
+
+    def pin(self, project_dir):
+        # Held for as long as a project's editors and shells are open on it.
+        # A shared flock, so browsers and the daemon sharing the working dir
+        # all see it, and a crashed browser never leaves it held
+        pin_file = self.pinFile(project_dir)
+        os.makedirs(os.path.dirname(pin_file), exist_ok=True)
+        fd = os.open(pin_file, os.O_RDONLY | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # Compressed while we waited for the lock
+        self.restore(project_dir)
+
+        def unpin():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            with self.lock:
+                self.last_open[os.path.basename(project_dir)] = time.time()
+                self.save()
+        return unpin
+
+    def tryLockUnpinned(self, project_dir):
+        # An exclusive flock, so nobody opens the project while it is
+        # compressed; None if it is open somewhere
+        pin_file = self.pinFile(project_dir)
+        os.makedirs(os.path.dirname(pin_file), exist_ok=True)
+        try:
+            fd = os.open(pin_file, os.O_RDONLY | os.O_CREAT, 0o666)
+        except PermissionError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def acquire(self, project_dir):
+        with self.changed:
+            while project_dir in self.busy:
+                self.changed.wait()
+            self.in_use[project_dir] = self.in_use.get(project_dir, 0) + 1
+        self.restore(project_dir)
+
+    def release(self, project_dir):
+        with self.lock:
+            self.in_use[project_dir] -= 1
+            if self.in_use[project_dir] == 0:
+                del self.in_use[project_dir]
+            self.last_open[os.path.basename(project_dir)] = time.time()
+            self.save()
+        self.enforceInBackground()
+
+    def restore(self, project_dir):
+        archive = self.archivePath(project_dir)
+        with self.changed:
+            while project_dir in self.busy:
+                self.changed.wait()
+            if not os.path.exists(archive) or os.path.exists(project_dir):
+                return False
+            self.busy.add(project_dir)
+        try:
+            shutil.unpack_archive(archive, extract_dir=self.working_dir, format=self.ARCHIVE_FORMAT)
+            os.unlink(archive)
+            # The archive held its own copies of deduplicated files; share
+            # them with the other projects again
+            with self.lock:
+                linked = self.blob_links.pop(os.path.basename(project_dir), [])
+                self.save()
+            if self.blob_store is not None:
+                for path in linked:
+                    path = os.path.join(project_dir, path)
+                    if os.path.isfile(path):
+                        self.blob_store.ingest(path)
+            if self.search_index is not None:
+                self.search_index.updateProject(project_dir)
+        finally:
+            with self.changed:
+                self.busy.discard(project_dir)
+                self.changed.notify_all()
+        return True
+
+    def compress(self, project_dir, blob_inodes=()):
+        linked = []
+        for root, _, files in os.walk(project_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                stat = os.lstat(path)
+                if (stat.st_dev, stat.st_ino) in blob_inodes:
+                    linked.append(os.path.relpath(path, project_dir))
+        os.makedirs(self.cold_dir, exist_ok=True)
+        archive = self.archivePath(project_dir)
+        staging = shutil.make_archive(
+            archive[:-len(self.ARCHIVE_EXTENSION)] + ".part", self.ARCHIVE_FORMAT,
+            root_dir=self.working_dir, base_dir=os.path.basename(project_dir))
+        os.replace(staging, archive)
+        with self.lock:
+            self.blob_links[os.path.basename(project_dir)] = linked
+            self.save()
+        shutil.rmtree(project_dir)
+        # Searches shouldn't point at files that are now only in the archive
+        if self.search_index is not None:
+            self.search_index.removeProject(project_dir)
+        return os.path.getsize(archive)
+
+    def projectDirs(self):
+        if not os.path.isdir(self.working_dir):
+            return []
+        return [os.path.join(self.working_dir, name) for name in os.listdir(self.working_dir)
+                if not name.startswith(".") and os.path.isdir(os.path.join(self.working_dir, name))]
+
+    def coldArchives(self):
+        if not os.path.isdir(self.cold_dir):
+            return []
+        return [os.path.join(self.cold_dir, name) for name in os.listdir(self.cold_dir)
+                if name.endswith(self.ARCHIVE_EXTENSION)]
+
+    def usage(self):
+        return treeSize(self.working_dir)
+
+    def enforceInBackground(self):
+        if self.budget_bytes is None:
+            return
+        with self.lock:
+            if self.enforcing:
+                return
+            self.enforcing = True
+
+        def body():
+            try:
+                self.enforce()
+            finally:
+                self.enforcing = False
+        threading.Thread(target=body, daemon=True).start()
+
+    def enforce(self):
+        if self.budget_bytes is None:
+            return []
+        if self.blob_store is not None:
+            self.blob_store.collectGarbage()
+        total = self.usage()
+        if total <= self.budget_bytes:
+            return []
+
+        def lastOpen(path):
+            name = os.path.basename(path)
+            if name.endswith(self.ARCHIVE_EXTENSION):
+                name = name[:-len(self.ARCHIVE_EXTENSION)]
+            return self.last_open.get(name, os.path.getmtime(path))
+
+        blob_inodes = set()
+        if self.blob_store is not None:
+            blob_inodes = self.blob_store.inodes()
+
+        reclaimed = []
+        now = time.time()
+        # Compress cold projects first, least recently opened first...
+        for project_dir in sorted(self.projectDirs(), key=lastOpen):
+            if total <= self.budget_bytes:
+                break
+            with self.lock:
+                if (project_dir in self.in_use or project_dir in self.busy or
+                        now - lastOpen(project_dir) < self.MIN_IDLE_SECONDS):
+                    continue
+                pin_fd = self.tryLockUnpinned(project_dir)
+                if pin_fd is None:
+                    continue
+                self.busy.add(project_dir)
+            # Compressing takes a while; only opening this project waits on it
+            try:
+                size = reclaimableSize(project_dir, blob_inodes)
+                total -= size - self.compress(project_dir, blob_inodes)
+            finally:
+                os.close(pin_fd)
+                with self.changed:
+                    self.busy.discard(project_dir)
+                    self.changed.notify_all()
+            reclaimed.append(project_dir)
+        if len(reclaimed) > 0 and self.blob_store is not None:
+            # Blobs only the compressed projects linked to
+            self.blob_store.collectGarbage()
+
+        # ...and only evict archives outright if that wasn't enough
+        for archive in sorted(self.coldArchives(), key=lastOpen):
+            if total <= self.budget_bytes:
+                break
+            with self.lock:
+                total -= os.path.getsize(archive)
+                os.unlink(archive)
+                name = os.path.basename(archive)[:-len(self.ARCHIVE_EXTENSION)]
+                self.last_open.pop(name, None)
+                self.blob_links.pop(name, None)
+            if self.search_index is not None:
+                self.search_index.removeProject(os.path.join(self.working_dir, name))
+            reclaimed.append(archive)
+        with self.lock:
+            self.save()
+        return reclaimed
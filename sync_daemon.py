@@ -0,0 +1,199 @@
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+import download_queue
+import mentor_dashboard
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "springboard-%d.sock" % os.getuid())
+
+
+class DaemonError(Exception):
+    pass
+
+
+def projectRecord(project):
+    return {
+        "unit": project.unit,
+        "name": project.name,
+        "date": project.date.isoformat(),
+        "work": project.work
+    }
+
+
+class SyncDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, download_clients, working_dir, max_workers, storage=None,
+                 search_index=None):
+        self.socket_path = socket_path
+        self.storage = storage
+        self.search_index = search_index
+        self.download_clients = download_clients
+        self.working_dir = working_dir
+        self.queue = download_queue.DownloadQueue(max_workers)
+        self.lock = threading.Lock()
+        self.html = None
+        self.projects = []
+        self.commands = {
+            "ping": self.ping,
+            "load": self.load,
+            "dashboard": self.dashboard,
+            "list": self.list,
+            "projects": self.projectRecords,
+            "fetch": self.fetch,
+            "status": self.status,
+        }
+        if os.path.exists(socket_path):
+            if DaemonClient(socket_path).available():
+                raise DaemonError("A daemon is already listening on %s" % socket_path)
+            os.unlink(socket_path)
+        super().__init__(socket_path, DaemonRequestHandler)
+
+    def initializeClients(self):
+        for client in self.download_clients.values():
+            if not client.initialized():
+                client.initialize(attemptAuthorization=False)
+
+    def server_close(self):
+        super().server_close()
+        self.queue.shutdown(wait=False)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def dispatch(self, request):
+        command = self.commands.get(request.get("command"))
+        if command is None:
+            raise DaemonError("Unknown command '%s'" % request.get("command"))
+        return command(request)
+
+    def findProjects(self, request):
+        with self.lock:
+            projects = self.projects
+        if "unit" in request and "name" in request:
+            return [project for project in projects
+                    if project.unit == request["unit"] and project.name == request["name"]]
+        query = request.get("query", "").lower()
+        return [project for project in projects
+                if query in ("%s %s" % (project.unit, project.name)).lower()]
+
+    def ping(self, request):
+        return True
+
+    def load(self, request):
+        projects = mentor_dashboard.getProjectsFromHTML(
+            request["html"],
+            download_clients=self.download_clients,
+            working_dir=self.working_dir,
+            storage=self.storage,
+            search_index=self.search_index)
+        with self.lock:
+            self.html = request["html"]
+            self.projects = mentor_dashboard.mergeProjects(self.projects, projects)
+            projects = self.projects
+        threading.Thread(target=self.prefetchMetadata, args=(projects,), daemon=True).start()
+        return len(projects)
+
+    def prefetchMetadata(self, projects):
+        try:
+            mentor_dashboard.prefetchMetadata(projects, self.download_clients)
+        except Exception:
+            pass
+
+    def dashboard(self, request):
+        with self.lock:
+            return self.html
+
+    def list(self, request):
+        return [projectRecord(project) for project in self.findProjects(request)]
+
+    def projectRecords(self, request):
+        with self.lock:
+            projects = self.projects
+        return [project.record() for project in projects]
+
+    def fetch(self, request):
+        matches = self.findProjects(request)
+        if len(matches) > 1 and "query" in request:
+            query = request["query"].lower()
+            exact = [project for project in matches
+                     if query in (project.name.lower(), ("%s %s" % (project.unit, project.name)).lower())]
+            if len(exact) > 0:
+                matches = exact
+        if len(matches) == 0:
+            raise DaemonError("No project matches the request")
+        if len(matches) > 1:
+            raise DaemonError("%d projects match the request" % len(matches))
+        return self.queue.submit(matches[0]).result()
+
+    def status(self, request):
+        with self.lock:
+            project_count = len(self.projects)
+        return {
+            "projects": project_count,
+            "pending_downloads": self.queue.pending(),
+            "max_workers": self.queue.max_workers,
+            "working_dir": self.working_dir,
+            "dedup": self.storage.blob_store.summary()
+                     if self.storage is not None and self.storage.blob_store is not None else None,
+            "requests": {client_name: client.scheduler.snapshot()
+                         for client_name, client in self.download_clients.items()
+                         if getattr(client, "scheduler", None) is not None}
+        }
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"ok": True, "result": self.server.dispatch(json.loads(line))}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class DaemonClient(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+
+    def request(self, command, **kwargs):
+        kwargs["command"] = command
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            with sock.makefile("rwb") as stream:
+                stream.write(json.dumps(kwargs).encode() + b"\n")
+                stream.flush()
+                response = json.loads(stream.readline())
+        if not response["ok"]:
+            raise DaemonError(response["error"])
+        return response["result"]
+
+    def available(self):
+        try:
+            return self.request("ping")
+        except (OSError, ValueError):
+            return False
+
+    def load(self, html):
+        return self.request("load", html=html)
+
+    def dashboard(self):
+        return self.request("dashboard")
+
+    def list(self, query=""):
+        return self.request("list", query=query)
+
+    def projects(self):
+        return self.request("projects")
+
+    def fetch(self, query=None, unit=None, name=None):
+        if query is not None:
+            return self.request("fetch", query=query)
+        return self.request("fetch", unit=unit, name=name)
+
+    def status(self):
+        return self.request("status")
@@ -0,0 +1,116 @@
+import http.server
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+import http_client
+
+PAYLOAD = bytes(range(256)) * 4096
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Every response claims keep-alive, then the server hangs up anyway,
+    # which is how pooled connections go stale
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.get("Range")))
+        self.close_connection = True
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        # Without a validator the client can't tell the file changed
+        validated = self.path != "/unvalidated"
+        if match is None:
+            if (self.path in ("/truncated", "/misaligned", "/resized", "/unvalidated") and
+                    len(Handler.requests) == 1):
+                # Drops the connection halfway through the first transfer
+                self.sendBody(200, PAYLOAD[:len(PAYLOAD) // 2], len(PAYLOAD), validated=validated)
+            else:
+                self.sendBody(200, PAYLOAD, len(PAYLOAD), validated=validated)
+            return
+        start = int(match.group(1))
+        if self.path == "/misaligned":
+            # Answers a different range than the one asked for
+            start = 0
+        total = len(PAYLOAD)
+        if self.path == "/resized":
+            # The right range, of a file that has grown since
+            total += 1
+        body = PAYLOAD[start:]
+        self.sendBody(206, body, len(body), "bytes %d-%d/%d" % (start, len(PAYLOAD) - 1, total))
+
+    def sendBody(self, status, body, length, content_range=None, validated=True):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if validated:
+            self.send_header("ETag", '"v1"')
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HttpClientTest(unittest.TestCase):
+    def setUp(self):
+        Handler.requests = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.client = http_client.HttpClient(connect_timeout=5, read_timeout=5)
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.pool.closeAll()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.working_dir)
+
+    def download(self, path):
+        metadata = self.client.downloadFile(self.base_url + path, self.working_dir)
+        with open(metadata["local_uri"], "rb") as f:
+            return f.read()
+
+    def testResumesInterruptedTransfer(self):
+        self.assertEqual(self.download("/truncated"), PAYLOAD)
+        self.assertEqual(Handler.requests, [
+            ("/truncated", None), ("/truncated", "bytes=%d-" % (len(PAYLOAD) // 2))])
+        self.assertEqual(os.listdir(self.working_dir), ["truncated"])
+
+    def testRestartsOnMisalignedRange(self):
+        self.assertEqual(self.download("/misaligned"), PAYLOAD)
+        # Asked to resume, was sent the file from the top, and started over
+        # rather than appending it
+        self.assertEqual([header for _, header in Handler.requests],
+                         [None, "bytes=%d-" % (len(PAYLOAD) // 2), None])
+
+    def testRestartsWhenTheFileChangedSize(self):
+        self.assertEqual(self.download("/resized"), PAYLOAD)
+        self.assertEqual([header for _, header in Handler.requests],
+                         [None, "bytes=%d-" % (len(PAYLOAD) // 2), None])
+
+    def testNeverResumesWithoutValidator(self):
+        self.assertEqual(self.download("/unvalidated"), PAYLOAD)
+        self.assertEqual(Handler.requests, [("/unvalidated", None), ("/unvalidated", None)])
+
+    def testReplacesEveryStaleConnection(self):
+        for _ in range(2):
+            connection = self.client.pool.connect("http", "127.0.0.1", self.server.server_address[1])
+            connection.request("GET", "/warmup")
+            connection.getresponse().read()
+            self.client.pool.release("http", "127.0.0.1", self.server.server_address[1], connection)
+        # Both idle connections were closed by the server; the request must
+        # not fall back on the second one after the first fails
+        _, response, pool_key = self.client.request(self.base_url + "/fresh", {})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), PAYLOAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,55 +1,64 @@
 #!/bin/bash
 #
-# tourguide.sh - sync the pwd of the shell to the contents of a file
+# tourguide.sh - sync the pwd of interactive shells to the project browser
 # author: naomi alterman (yours.truly@nlalterman.com)
-# last modified: 10/27/2020
+# last modified: 10/19/2026
+#
+# Source this from any number of bash or zsh shells. Each attached shell
+# changes directory in place, right before its next prompt, whenever the
+# browser selects a new project. Shells attached to different sessions
+# follow different browsers.
 #
 
 usage() {
-    echo "usage: $0 WATCHFILE [SHELL]"
-    echo "      WATCHFILE   a file whose sole contents is the absolute path the"
-    echo "                  current shell should jump to"
-    echo "      SHELL       the shell to invoke (default is /bin/bash)"
-    echo "Make WATCHFILE empty to stop script"
+    echo "usage: source $0 [SESSION]"
+    echo "      SESSION     the browser session to follow (default is"
+    echo "                  \$SPRINGBOARD_SESSION, or 'default')"
+    echo "Run 'tourguide_detach' to stop following the browser"
 }
 
-if [[ "$#" -lt 1 || "$#" -gt 2 ]]; then
+if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then
     usage
     exit 1
 fi
 
-SHELL=/bin/bash
-WATCH_FILE=$(realpath $1)
-set -m
-
-if [[ "$#" -gt 1 ]]; then
-SHELL=$2
+_springboard_session="${1:-${SPRINGBOARD_SESSION:-default}}"
+# The browser rejects anything else, so both sides agree on the channel path
+if [[ ! "$_springboard_session" =~ ^[A-Za-z0-9_-]+$ ]]; then
+    echo "tourguide: invalid session name '$_springboard_session'" \
+         "(use letters, digits, '-' and '_')" >&2
+    unset _springboard_session
+    return 1
 fi
+_springboard_channel="${TMPDIR:-/tmp}/springboard-$(id -u)/$_springboard_session/directory"
+_springboard_seen=""
 
-wait_on_file() {
-    inotifywait -q -e modify $1 >/dev/null;
-}
-
-shell_killswitch(){
-    wait_on_file $WATCH_FILE;
-    kill -9 $current_shell_pid;
+_springboard_sync() {
+    local new_dir
+    [[ -s "$_springboard_channel" ]] || return 0
+    new_dir=$(<"$_springboard_channel")
+    if [[ "$new_dir" != "$_springboard_seen" ]]; then
+        _springboard_seen="$new_dir"
+        if [[ -d "$new_dir" ]]; then
+            builtin cd -- "$new_dir" &&
+                echo "tourguide: now in $new_dir ($(ls -A | wc -l) entries)"
+        fi
+    fi
+    return 0
 }
 
-pid_to_jobspec(){
-    jobs -l | gawk 'match($0, /\[([0-9]+)\].?\s+'$1'/, group) { print group[1] }'
+tourguide_detach() {
+    if [[ -n "$ZSH_VERSION" ]]; then
+        precmd_functions=(${precmd_functions:#_springboard_sync})
+    else
+        PROMPT_COMMAND="${PROMPT_COMMAND//_springboard_sync;/}"
+    fi
 }
 
-run_loop() {
-    while [ -s $WATCH_FILE ]
-    do
-        new_dir=`cat $WATCH_FILE`;
-        pushd "$new_dir" && \
-            { $SHELL --init-file <(echo "tree") & export current_shell_pid=$!; } &&
-            popd &&
-            { shell_killswitch & fg `pid_to_jobspec $current_shell_pid`; }
-    done
-}
-
-run_loop
+if [[ -n "$ZSH_VERSION" ]]; then
+    precmd_functions+=(_springboard_sync)
+elif [[ "$PROMPT_COMMAND" != *_springboard_sync* ]]; then
+    PROMPT_COMMAND="_springboard_sync;${PROMPT_COMMAND}"
+fi
 
 # end of line <3